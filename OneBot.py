@@ -1,10 +1,22 @@
 from utils import (handle_exceptions_for_methods, 
                    instantiate_from_config, 
                    is_request_success, 
+                   CreateSession,
+                   merge_dict,
                    logger)
 from timeout_decorator import timeout
+from supervisor import AutoCommandSupervisor
+from admission import AdmissionController
+from batching import CommandBatcher
+from history import MessageHistory, HistoryRecord, CompactMessage
+from media import MediaTransfer
+from shutdown import ShutdownCoordinator, ResetChildSignals, STOP_GRACE
+from reload import Reloader
+from attributes import BuildAttributeIndex
+from state import StateStore
+from events import MessageEvent, Event, EventRouter, SUPPORTED_SEGMENTS, REPLY_PREFIX_PATTERN
+from server import CreateApp, StartServer
 from omegaconf import OmegaConf
-from fastapi import FastAPI
 from copy import deepcopy
 import multiprocessing
 import threading
@@ -13,12 +25,15 @@ import requests
 import logging
 import inspect
 import signal
-import uvicorn
 import time
 import json
 import sys
 import os
 
+REQUEST_TIMEOUT = 30
+# Control requests sent for every message, not worth an info line each
+QUIET_CONTROLS = ["record"]
+
 @handle_exceptions_for_methods
 class OneBot:
     def __init__(self, 
@@ -29,14 +44,40 @@ class OneBot:
                  Logger: logging.Logger,
                  Notice: str="",
                  RetryCount: int=3,
+                 ShutdownTimeout: float=30,
+                 PostCommandTimeout: float=30,
+                 StateDir: str="./state",
+                 StateCompactBytes: int=1 << 20,
+                 StateCompactInterval: float=600,
+                 HotReload: bool=False,
+                 ConfigPath: str="",
+                 Admission: dict={},
+                 MediaTransfer: dict={},
+                 MessageHistory: dict={},
                  ManualCommands: dict={},
                  AutoCommands: dict={},
                  PostCommands: dict={},
+                 EventCommands: dict={},
+                 SelfID: int=0,
+                 Shared=None,
                  **kwargs):
         
+        self.SelfID = SelfID
+        # Resources shared with the other accounts when hosted by `host.OneBotHost`
+        self.Shared = Shared
         self.AdminID = AdminID
         self.Notice = Notice
         self.RetryCount = RetryCount
+        self.ShutdownTimeout = ShutdownTimeout
+        self.PostCommandTimeout = PostCommandTimeout
+        self.StateDir = StateDir
+        self.StateCompactBytes = StateCompactBytes
+        self.StateCompactInterval = StateCompactInterval
+        self.HotReload = HotReload
+        self.ConfigPath = ConfigPath
+        self.AdmissionConfig = Admission
+        self.MediaConfig = MediaTransfer
+        self.HistoryConfig = MessageHistory
         self.HttpPostHost = HttpPostHost
         self.HttpPostPort = HttpPostPort
         self.HttpAPIURL = HttpAPIURL
@@ -45,16 +86,34 @@ class OneBot:
         if kwargs != {}:
             logger.warning("Unrecognized parameters: {}".format(kwargs))
         
+        if self.SelfID:
+            logger.info("SelfID: {}".format(self.SelfID))
         logger.info("AdminID: {}".format(self.AdminID))
         logger.info("HttpPostHost: {}".format(self.HttpPostHost))
         logger.info("HttpPostPort: {}".format(self.HttpPostPort))
         logger.info("HttpAPIURL: {}".format(self.HttpAPIURL))
         logger.info("Notice: {}".format(self.Notice))
         logger.info("RetryCount: {}".format(self.RetryCount))
+        logger.info("ShutdownTimeout: {}".format(self.ShutdownTimeout))
+        logger.info("PostCommandTimeout: {}".format(self.PostCommandTimeout))
+        logger.info("StateDir: {}".format(self.StateDir))
+        logger.info("HotReload: {}".format(self.HotReload))
+        logger.info("Admission: {}".format(self.AdmissionConfig))
+        logger.info("MediaTransfer: {}".format(self.MediaConfig))
+        logger.info("MessageHistory: {}".format(self.HistoryConfig))
         
-        self._init_commands(ManualCommands, AutoCommands, PostCommands)
+        self.Session = self.Shared.Session if self.Shared else CreateSession()
+        self._init_commands(ManualCommands, AutoCommands, PostCommands, EventCommands)
         self._init_auto_commands()
+        self._init_state()
+        self.BuildAttributeIndexes()
+        self._init_admission()
+        self._init_media()
+        self._init_history()
+        self._init_batcher()
         self._init_post_commands()
+        self._init_reloader()
+        self.BuildEventRouter()
         self._init_receiver()
         self._init_server()
         
@@ -63,23 +122,27 @@ class OneBot:
     def _init_commands(self, 
                        ManualCommands: dict ,
                        AutoCommands: dict,
-                       PostCommands: dict):
-        Manager = multiprocessing.Manager()
+                       PostCommands: dict,
+                       EventCommands: dict):
+        Manager = self.Shared.Manager if self.Shared else multiprocessing.Manager()
         Commands = Manager.dict()
         self.COMMAND_LOCK = Manager.Lock()
-        OriginalCommands = {**ManualCommands, **AutoCommands, **PostCommands}
+        self.ControlQueue = Manager.Queue()
+        self.TerminalJobs = Manager.dict()
+        self.AttributeChanges = Manager.dict()
+        self.BackendStats = Manager.dict()
+        self.BACKEND_LOCK = Manager.Lock()
+        # Interactive Text2Image requests waiting on the backend, in shared memory so that every
+        # command process sees it
+        self.InteractiveJobs = multiprocessing.Value("i", 0)
+        self.Manager = Manager
+        OriginalCommands = {**ManualCommands, **AutoCommands, **PostCommands, **EventCommands}
         CommandFunctions = {}
         
         for cmd_type, commands in {"Manual": ManualCommands, "Auto": AutoCommands, 
-                                   "Post": PostCommands}.items():
+                                   "Post": PostCommands, "Event": EventCommands}.items():
             for cmd_name in commands:
-                cfg = deepcopy(commands[cmd_name])
-                func, params, extra_params = instantiate_from_config(cfg)
-                cmd = {"CommandType": cmd_type, "target": commands[cmd_name]["target"]}
-                if params:
-                    cmd.update({"params": params})
-                if extra_params:
-                    cmd.update(extra_params)
+                func, cmd = self.BuildCommand(cmd_type, commands[cmd_name])
                 CommandFunctions[cmd_name] = func
                 Commands[cmd_name] = cmd
             
@@ -88,38 +151,166 @@ class OneBot:
         self.OrginalCommands = OriginalCommands
         logger.info("Commands: \n{}".format(json.dumps(dict(self.Commands), indent=2)))
         
+    def BuildCommand(self, 
+                     cmd_type: str, 
+                     cmd_cfg: dict):
+        func, params, extra_params = instantiate_from_config(deepcopy(cmd_cfg))
+        cmd = {"CommandType": cmd_type, "target": cmd_cfg["target"]}
+        if params:
+            cmd.update({"params": params})
+        if extra_params:
+            cmd.update(extra_params)
+        return func, cmd
+        
     def _init_auto_commands(self):
-        commands = self.Commands
-        for cmd_name in commands:
-            cmd_dict = commands[cmd_name]
-            if cmd_dict["CommandType"] == "Auto":
-                living_params = {"running_process": 0, "last_runtime": 0}
-                cmd_dict["living_params"] = living_params
-            commands[cmd_name] = cmd_dict
-        self.Commands = commands
+        self.Supervisor = AutoCommandSupervisor(self)
         logger.info("Auto commands: \n{}".format(
                          json.dumps({key: dict(value) for key, value in self.Commands.items() 
                                      if value["CommandType"] == "Auto"}, indent=2))) 
         
+    def _init_state(self):
+        self.State = StateStore(self.StateDir, self.StateCompactBytes, self.StateCompactInterval, self.COMMAND_LOCK)
+        state = self.State.Load()
+        saved_config = state.get("config", {})
+        
+        with self.COMMAND_LOCK:
+            commands = self.Commands
+            for cmd_name, saved in state.get("commands", {}).items():
+                if cmd_name not in commands:
+                    logger.warning("Command {} in saved state no longer exists, skip".format(cmd_name))
+                    continue
+                cmd_dict = commands[cmd_name]
+                if saved.get("target", cmd_dict["target"]) != cmd_dict["target"]:
+                    logger.warning("Target of command {} changed, skip saved state".format(cmd_name))
+                    continue
+                if cmd_name in saved_config and saved_config[cmd_name] != self.OrginalCommands[cmd_name]:
+                    # The config file was edited since the state was saved, the edit wins
+                    logger.info("Config of command {} changed, only restore runtime data".format(cmd_name))
+                    saved = {key: saved[key] for key in saved if key not in ["params", "extra_params"]}
+                commands[cmd_name] = merge_dict(cmd_dict, saved)
+            self.Commands = commands
+        
+        for cmd_name, stats in state.get("scheduler", {}).items():
+            self.Supervisor.get_stats(cmd_name).update({**stats, "running": 0})
+        
+        self.State.Compact(self.CaptureState)
+        logger.info("Runtime state restored for commands: {}".format(list(state.get("commands", {}).keys())))
+        
+    def BuildAttributeIndexes(self, 
+                              cmd_names: list=[]):
+        # Forked command processes inherit the index, so ChangeAttribute never walks a whole command
+        attribute_index = dict(getattr(self, "AttributeIndex", {}))
+        for cmd_name in cmd_names or list(self.Commands.keys()):
+            if cmd_name in self.Commands.keys():
+                attribute_index[cmd_name] = BuildAttributeIndex(self.Commands[cmd_name]) or {}
+            else:
+                attribute_index.pop(cmd_name, None)
+        self.AttributeIndex = attribute_index
+        
+    def PublishAttributeChanges(self, 
+                                cmd_name: str, 
+                                changes: dict):
+        # Running workers poll only the changed paths instead of reloading the whole command
+        version = time.time_ns()
+        with self.COMMAND_LOCK:
+            published = self.AttributeChanges.get(cmd_name, {})
+            published.update({key: (version, value) for key, value in changes.items()})
+            self.AttributeChanges[cmd_name] = published
+        
+    def PollAttributeChanges(self, 
+                             cmd_name: str, 
+                             since: int=0):
+        published = self.AttributeChanges.get(cmd_name, {})
+        changes = {key: value for key, (version, value) in published.items() if version > since}
+        latest = max([version for version, _ in published.values()] + [since])
+        return changes, latest
+        
+    def CaptureState(self):
+        return {"config": self.OrginalCommands, 
+                "commands": {cmd_name: self.Commands[cmd_name] for cmd_name in self.Commands.keys()}, 
+                "scheduler": self.Supervisor.Stats}
+        
+    def _init_admission(self):
+        # Created before any command process is forked so that the counters are shared with them
+        self.Admission = AdmissionController(self, **self.AdmissionConfig)
+        
+    def _init_media(self):
+        self.Media = self.Shared.Media if self.Shared else MediaTransfer(**self.MediaConfig)
+        
+    def _init_history(self):
+        self.History = MessageHistory(**self.HistoryConfig)
+        
+    def _init_batcher(self):
+        self.Batcher = CommandBatcher(self)
+        self.Batcher.start()
+        
     def _init_post_commands(self):
+        self.Shutdown = ShutdownCoordinator(self, self.ShutdownTimeout, self.PostCommandTimeout)
+        self.Shutdown.RegisterDrainer("auto_commands", self.Supervisor.Drain)
+        self.Shutdown.RegisterDrainer("terminal_jobs", self.DrainTerminalJobs)
+        self.Shutdown.RegisterDrainer("command_batches", self.Batcher.Drain)
+        
+        self.StopSignal = 0
+        
         def signal_handler(sig, frame):
-            logger.info("Received signal {}, prepare to exit".format(sig))
-            self.HandlePostCommands()
-            logger.info("Post commands handled, exit")
-            sys.exit(0)
+            if not self.Shutdown.is_main_process():
+                # A Ctrl+C reaches the whole process group, forked command processes finish their work
+                return
+            # The handler may interrupt the main loop while it holds a lock, so it only records
+            # the signal and the loop shuts down between two ticks
+            logger.info("Received signal {}, shut down after the current tick".format(sig))
+            self.StopSignal = sig
             
-        signal.signal(signal.SIGINT, signal_handler)
-        signal.signal(signal.SIGTERM, signal_handler)
+        # A hosted account is stopped by its host, which owns the signal handlers
+        if not self.Shared:
+            signal.signal(signal.SIGINT, signal_handler)
+            signal.signal(signal.SIGTERM, signal_handler)
+            os.register_at_fork(after_in_child=ResetChildSignals)
         logger.info("Post commands: \n{}".format(
                          json.dumps({key: dict(value) for key, value in self.Commands.items() 
                                      if value["CommandType"] == "Post"}, indent=2)))
         
+    def Stop(self, 
+             sig: int=signal.SIGTERM):
+        self.Shutdown.Shutdown(sig)
+        self.State.Compact(self.CaptureState)
+        
+    def DrainTerminalJobs(self, 
+                          deadline: float):
+        # Terminal jobs run in their own process group and would outlive the command process,
+        # a `tail -f` never ends by itself, so they are stopped right away like auto commands
+        jobs = dict(self.TerminalJobs)
+        abandoned = []
+        for job_id, job in jobs.items():
+            try:
+                os.killpg(job_id, signal.SIGTERM)
+            except ProcessLookupError:
+                continue
+            abandoned.append("terminal job {}: {}".format(job_id, job["command"]))
+        grace = min(deadline, time.time() + STOP_GRACE)
+        while self.TerminalJobs and time.time() < grace:
+            time.sleep(0.1)
+        for job_id in self.TerminalJobs.keys():
+            try:
+                os.killpg(job_id, signal.SIGKILL)
+            except ProcessLookupError:
+                continue
+        return abandoned
+        
+    def _init_reloader(self):
+        self.Reloader = Reloader(self, self.ConfigPath)
+        self.ControlHandlers = {"reload": self.Reloader.Reload, 
+                                "reindex": self.BuildAttributeIndexes, 
+                                "record": self.History.Add}
+        if self.HotReload and not self.Shared:
+            self.Reloader.start_watching()
+        
     @timeout(30)
     def _init_receiver(self):
         for i in range(self.RetryCount):
             request_url = self.HttpAPIURL + "/get_status"
             # if True: 
-            r = requests.get(request_url)
+            r = self.Session.get(request_url, timeout=REQUEST_TIMEOUT)
             if self.is_request_success(r):
                 # if True: 
                 if r.json().get("data", {}).get("online", False):
@@ -136,16 +327,10 @@ class OneBot:
         sys.exit(1)
         
     def _init_server(self):
-        app = FastAPI()
-        @app.post("/")
-        async def read_event(event: dict):
-            logger.debug("Receive Event :{}".format(event))
-            if "message_id" in event:
-                self.HandleMessage(event)
-    
-        def run_server():
-            uvicorn.run(app, host=self.HttpPostHost, port=self.HttpPostPort)
-        threading.Thread(target=run_server, daemon=True).start()
+        if self.Shared:
+            return
+        app = CreateApp(lambda self_id: self, self.Media)
+        self.Server = StartServer(app, self.HttpPostHost, self.HttpPostPort)
         
     def is_admin(self, 
                  target_id: int):
@@ -155,7 +340,7 @@ class OneBot:
         for i in range(self.RetryCount):
             request_url = self.HttpAPIURL + "/clean_cache"
             # if True: 
-            r = requests.get(request_url)
+            r = self.Session.get(request_url, timeout=REQUEST_TIMEOUT)
             if self.is_request_success(r):
                 logger.info("Cache cleaned")
                 return "缓存已清空"
@@ -165,6 +350,19 @@ class OneBot:
         logger.warning("Failed to clean cache after {} retries".format(self.RetryCount))
         return "清空缓存失败"
             
+    def CallAPI(self, 
+                action: str, 
+                params: dict={}):
+        for i in range(self.RetryCount):
+            r = self.Session.post(self.HttpAPIURL + "/" + action, json=params, timeout=REQUEST_TIMEOUT)
+            if self.is_request_success(r):
+                logger.debug("Call API {} with {}".format(action, params))
+                return r.json()
+            logger.warning("Failed to call API {}: {}".format(action, r.text))
+            logger.warning("Retry in 1 second")
+            time.sleep(1)
+        logger.warning("Failed to call API {} after {} retries".format(action, self.RetryCount))
+            
     def is_request_success(self, 
                            response: requests.Response):
         if is_request_success(response):
@@ -180,9 +378,21 @@ class OneBot:
                "HttpAPIURL": self.HttpAPIURL,
                "Notice": self.Notice,
                "RetryCount": self.RetryCount,
+               "ShutdownTimeout": self.ShutdownTimeout,
+               "PostCommandTimeout": self.PostCommandTimeout,
+               "StateDir": self.StateDir,
+               "StateCompactBytes": self.StateCompactBytes,
+               "StateCompactInterval": self.StateCompactInterval,
+               "HotReload": self.HotReload,
+               "Admission": self.AdmissionConfig,
+               "MediaTransfer": self.MediaConfig,
+               "MessageHistory": self.HistoryConfig,
                "ManualCommands": {},
                "AutoCommands": {},
-               "PostCommands": {}}
+               "PostCommands": {},
+               "EventCommands": {}}
+        if self.SelfID:
+            cfg["SelfID"] = self.SelfID
         
         for cmd_name in self.Commands.keys():
             CommandType = self.Commands[cmd_name]["CommandType"]
@@ -225,10 +435,12 @@ class OneBot:
                 message = " "
             return {"type": "text", "data": {"text": message}}
         if type in ["image", "record", "video", "file"]:
-            if os.path.exists(message):
-                return {"type": type, "data": {"file": message}}
-            elif message.startswith("http://") or message.startswith("https://"):
+            if message.startswith("http://") or message.startswith("https://"):
                 return {"type": type, "data": {"file": message, "url": message}}
+            elif message.startswith("base64://") or message.startswith("file://"):
+                return {"type": type, "data": {"file": message}}
+            elif os.path.exists(message):
+                return {"type": type, "data": self.Media.Prepare(message) or {"file": message}}
             else:
                 return {"type": "text", "data": {"text": "文件不存在: {}".format(message)}}
         if type == "at":
@@ -241,7 +453,6 @@ class OneBot:
         logger.warning("Temporary not support type to preprocess: {}".format(type))
         return {"type": "text", "data": {"text": "当前不支持的消息类型: [{}:{}]".format(type, message)}}
     
-    @timeout(120)
     def SendMessage(self, 
                     message: int|str|list|dict, 
                     message_type: str, 
@@ -253,48 +464,147 @@ class OneBot:
             postdata.update({"group_id": target_id} if message_type == "group" else {"user_id": target_id})
             for i in range(self.RetryCount): 
                 # if True:
-                r = requests.post(self.HttpAPIURL + "/send_msg", json=postdata)
+                r = self.Session.post(self.HttpAPIURL + "/send_msg", json=postdata, timeout=REQUEST_TIMEOUT)
                 if self.is_request_success(r):
                     logger.info("Send message to [{}:{}]: {}".format(
                                      message_type, target_id, message))
+                    self.RecordSentMessage(message, message_type, target_id, r.json().get("data") or {})
                     return
                 logger.warning("Failed to send message: {}".format(r.text))
                 logger.warning("Retry in 1 second")
                 time.sleep(1)
             logger.warning("Failed to send message after {} retries".format(self.RetryCount))
     
-    def HandleMessage(self, 
-                      meta_message: dict):
-        logger.debug("Receive message: \n{}".format(json.dumps(meta_message, indent=2)))
+    def RecordSentMessage(self, 
+                          message: list, 
+                          message_type: str, 
+                          target_id: int, 
+                          data: dict):
+        if not data.get("message_id"):
+            return
+        # A reply of a single segment is preprocessed into a dict, not a list
+        segments = message if isinstance(message, list) else [message]
+        record = HistoryRecord(data["message_id"], message_type, target_id, int(time.time()), 
+                               self.SelfID, "", *CompactMessage(segments))
+        if self.Shutdown.is_main_process():
+            self.History.Add(record)
+        else:
+            # Messages sent by command processes reach the main process's history through the control queue
+            self.RequestControl("record", record=record)
+    
+    def BuildEventRouter(self):
+        router = EventRouter()
+        router.Use(self.LogEvent)
+        router.Use(self.RecordMessage, ["message"])
+        router.Use(self.FilterMessage, ["message"])
+        router.Use(self.ParseCommand, ["message"])
+        router.Use(self.AdmitCommand, ["message"])
+        router.Register("message", self.HandleMessage)
+        batch_windows = {}
+        for cmd_name in self.Commands.keys():
+            cmd_dict = self.Commands[cmd_name]
+            extra_params = cmd_dict.get("extra_params", {})
+            if extra_params.get("batch_window", 0) > 0:
+                batch_windows[cmd_name] = (extra_params["batch_window"], extra_params.get("batch_max", 8))
+            if cmd_dict["CommandType"] == "Event":
+                event_key = cmd_dict.get("extra_params", {}).get("event", "")
+                if not event_key:
+                    logger.warning("Event command {} has no `event` to listen on".format(cmd_name))
+                    continue
+                router.Register(event_key, lambda event, cmd_name=cmd_name: self.HandleEventCommand(cmd_name, event))
+        self.Batcher.Configure(batch_windows)
+        self.EventTypes = router.Compile()
+        self.Router = router
+        logger.info("Event types handled: {}".format(sorted(self.EventTypes)))
+        
+    def LogEvent(self, 
+                 event: MessageEvent|Event, 
+                 call_next):
+        if event.post_type == "message":
+            logger.info("{}{}({}): {}".format(f"[Group({event.group_id})] - " if event.group_id else "", 
+                                             event.nickname, event.sender_id, event.raw_message))
+        elif event.post_type == "meta_event":
+            logger.debug("Receive event {}".format(event.key))
+        else:
+            logger.info("Receive event {}: {}".format(event.key, event.data))
+        call_next(event)
         
-        message_type = meta_message.get("message_type", None)
-        message_list = meta_message.get("message", [])
-        if not (message_type and message_list):
+    def RecordMessage(self, 
+                      event: MessageEvent, 
+                      call_next):
+        if event.message_id:
+            text, images, _ = CompactMessage(event.message)
+            self.History.Add(HistoryRecord(event.message_id, event.message_type, event.target_id, event.time, 
+                                           event.sender_id, event.nickname, text, images, event.reply_id))
+        call_next(event)
+        
+    def FilterMessage(self, 
+                      event: MessageEvent, 
+                      call_next):
+        if not (event.message_type and event.message):
             logger.warning("Not a message event")
             return
-        message_id = meta_message["message_id"]
-        sender_id = meta_message["sender"]["user_id"]
-        group_id = meta_message.get("group_id", "")
-        type = message_list[0]["type"]
-        if not (type in ["text", "face", "image", "record", "video", "at", "rps", "dice", "shake", 
-                         "poke", "share", "contact", "location", "music", "reply", "forward", "node",
-                         "xml", "json"]):
+        type = event.message[0]["type"]
+        if type not in SUPPORTED_SEGMENTS:
             logger.warning("Type unsupported: {}".format(type))
             return
-        message = meta_message["raw_message"]
-        nick_name = meta_message["sender"]["nickname"]
-        target_id = group_id if message_type == "group" else sender_id
-        
-        logger.info("{}{}({}): {}".format(f"[Group({group_id})] - " if group_id else "", 
-                                               nick_name, sender_id, message))
+        call_next(event)
         
-        splited_message = message.split("|", 1)
+    def ParseCommand(self, 
+                     event: MessageEvent, 
+                     call_next):
+        raw_message = event.raw_message
+        if event.reply_id:
+            raw_message = REPLY_PREFIX_PATTERN.sub("", raw_message, count=1)
+        splited_message = raw_message.split("|", 1)
         if len(splited_message) > 1 and splited_message[0] in self.Commands:
-            process = multiprocessing.Process(target=self.HandleCommand, 
-                                                args=(splited_message[0], splited_message[1], 
-                                                    message_type, sender_id, target_id, message_id))
-            process.start()
-            logger.debug("Start a process for command '{}'".format(splited_message[0]))
+            event.cmd_name, event.argument = splited_message
+            call_next(event)
+            
+    def AdmitCommand(self, 
+                     event: MessageEvent, 
+                     call_next):
+        admitted, reason = self.Admission.Admit(event.cmd_name, event.sender_id, 
+                                                event.group_id, event.target_id) or (True, "")
+        if not admitted:
+            logger.info("Reject command '{}' from {}: {}".format(event.cmd_name, event.sender_id, reason))
+            if self.Admission.should_notice(event.sender_id):
+                threading.Thread(target=self.SendMessage, args=(reason, event.message_type, event.target_id, "text"), 
+                                 daemon=True).start()
+            return
+        call_next(event)
+    
+    def HandleMessage(self, 
+                      event: MessageEvent):
+        if self.Batcher.is_batched(event.cmd_name):
+            self.Batcher.Add(event)
+            return
+        self.StartCommand(event, event.argument)
+        
+    def StartCommand(self, 
+                     event: MessageEvent, 
+                     message: str):
+        process = multiprocessing.Process(target=self.HandleCommand, 
+                                          args=(event.cmd_name, message, event.message_type, 
+                                                event.sender_id, event.target_id, event.message_id), 
+                                          kwargs={"event": event})
+        process.start()
+        self.Shutdown.Track(process, "{} for [{}:{}]".format(event.cmd_name, event.message_type, event.target_id))
+        logger.debug("Start a process for command '{}'".format(event.cmd_name))
+        return process
+        
+    def HandleEventCommand(self, 
+                           cmd_name: str, 
+                           event: Event):
+        extra_params = self.Commands[cmd_name].get("extra_params", {})
+        message_type = extra_params.get("message_type", event.message_type)
+        target_id = extra_params.get("target_id", event.target_id)
+        process = multiprocessing.Process(target=self.HandleCommand, 
+                                          args=(cmd_name, "", message_type, event.user_id, target_id, 0), 
+                                          kwargs={"event": event})
+        process.start()
+        self.Shutdown.Track(process, "{} for {}".format(cmd_name, event.key))
+        logger.debug("Start a process for event command '{}'".format(cmd_name))
                 
     def HandleCommand(self, 
                       cmd_name: str, 
@@ -303,7 +613,8 @@ class OneBot:
                       sender_id: int,
                       target_id: int, 
                       message_id: int, 
-                      send_message: bool=True):
+                      send_message: bool=True, 
+                      event: MessageEvent|Event=None):
         cmd_func = self.CommandFunctions[cmd_name]
         # cmd_func, *_ = instantiate_from_config(deepcopy(self.Commands[cmd_name]))
         params = self.Commands[cmd_name].get("params", {})
@@ -320,14 +631,18 @@ class OneBot:
         params.update(extra_params)
                 
         all_params = {"bot": self, "message": message, "message_type": message_type, "cmd_name": cmd_name,
-                      "sender_id": sender_id, "target_id": target_id, "message_id": message_id, **params}
+                      "sender_id": sender_id, "target_id": target_id, "message_id": message_id, 
+                      "event": event, "quoted_message": self.History.Get(getattr(event, "reply_id", 0)), 
+                      **params}
         input_params = {}
         sig = inspect.signature(cmd_func)
         for param in sig.parameters:
             if param in all_params:
                 input_params.update({param: all_params[param]})
             
-        result = cmd_func(**input_params)
+        # Command functions are wrapped by `handle_exceptions`, which turns a failure into None.
+        # Call the function underneath so that a failure propagates and the caller can tell.
+        result = getattr(cmd_func, "__wrapped__", cmd_func)(**input_params)
         type = extra_params.get("type", "text")
         message = None
         if result is not None:
@@ -344,66 +659,66 @@ class OneBot:
         message_type = self.Commands[cmd_name]["extra_params"].get("message_type", "")
         target_id = self.Commands[cmd_name]["extra_params"].get("target_id", 0)
         send = self.Commands[cmd_name]["extra_params"].get("send", False)
-        message, *_, type  = self.HandleCommand(cmd_name, "", message_type, 0, target_id, 0, send_message=False)
-        with self.COMMAND_LOCK:
-            commands = self.Commands
-            cmd_dict = commands[cmd_name]
-            living_params = cmd_dict["living_params"]
-            living_params["running_process"] = max(0, living_params["running_process"] - 1)
-            commands[cmd_name] = cmd_dict
-            self.Commands = commands
-        logger.debug("Finish a process for auto command '{}', now {} / {} process is alive".format(
-                           cmd_name, self.Commands[cmd_name]["living_params"]["running_process"], 
-                           self.Commands[cmd_name]["extra_params"].get("num_process", 1)))
+        handled = self.HandleCommand(cmd_name, "", message_type, 0, target_id, 0, send_message=False)
+        if handled is None:
+            # The command raised, `HandleCommand` has logged it
+            return False
+        message, *_, type = handled
+        logger.debug("Finish a process for auto command '{}'".format(cmd_name))
         if message is not None and send:
             self.SendMessage(message, message_type, target_id, type)
+        return True
     
     def HandleAutoCommands(self):
-        with self.COMMAND_LOCK:
-            commands = self.Commands
-            for cmd_name in commands:
-                if commands[cmd_name]["CommandType"] == "Auto":
-                    cmd_dict = commands[cmd_name]
-                    living_params = cmd_dict["living_params"]
-                    if not cmd_dict["extra_params"]["auto_params"]["run"]:
-                        continue
-                    now = time.time()
-                    interval = now - living_params["last_runtime"]
-                    if interval < cmd_dict["extra_params"]["auto_params"]["min_execution_interval"]:
-                        continue
-                    if interval > cmd_dict["extra_params"]["auto_params"]["longest_idle_interval"]:
-                        living_params["running_process"] = 0
-                        logger.warning("Auto command {} hasn't run for {}s, reset".format(cmd_name, interval))
-                    num_process = cmd_dict["extra_params"]["auto_params"].get("num_process", 1)
-                    running_process = max(0, living_params["running_process"])
-                    for i in range (num_process - running_process):
-                        process = multiprocessing.Process(target=self.HandleAutoCommand, 
-                                                        args=(cmd_name,))
-                        running_process += 1
-                        living_params["running_process"] = running_process
-                        living_params["last_runtime"] = time.time()
-                        process.start()
-                        logger.debug("Start a process for auto command '{}', now {} / {} process is alive".format(
-                                          cmd_name, living_params["running_process"], num_process))
-                    cmd_dict["living_params"] = living_params
-                    commands[cmd_name] = cmd_dict
-            self.Commands = commands
+        self.Supervisor.Supervise()
+            
+    def RequestControl(self, 
+                       action: str, 
+                       reply_to: int=0, 
+                       **kwargs):
+        # Commands run in forked processes, anything that has to change the main process goes through here
+        self.ControlQueue.put({"action": action, "reply_to": reply_to, "kwargs": kwargs})
+        
+    def HandleControls(self):
+        while not self.ControlQueue.empty():
+            request = self.ControlQueue.get_nowait()
+            handler = self.ControlHandlers.get(request["action"], None)
+            if handler is None:
+                logger.warning("Unknown control request: {}".format(request))
+                continue
+            if request["action"] in QUIET_CONTROLS:
+                logger.debug("Handle control request: {}".format(request))
+            else:
+                logger.info("Handle control request: {}".format(request))
+            result = handler(**request["kwargs"])
+            if request["reply_to"]:
+                result = result if result is not None else "{} 执行失败, 请查看日志".format(request["action"])
+                self.SendMessage(result, "private", request["reply_to"], "text")
             
     def HandlePostCommands(self):
-        for cmd_name in self.Commands.keys():
-            if self.Commands[cmd_name]["CommandType"] == "Post":
-                logger.info("Handle post command: {}".format(cmd_name))
-                self.HandleCommand(cmd_name, "", "", 0, 0, 0, False)
+        return self.Shutdown.RunPostCommands(time.time() + self.PostCommandTimeout)
+            
+    def Tick(self):
+        self.HandleControls()
+        self.HandleAutoCommands()
+        self.Shutdown.Reap()
+        self.State.MaybeCompact(self.CaptureState)
+        self.Media.MaybePrune()
             
     def run(self):
         
-        while True:
+        while not self.StopSignal:
             try:
-                self.HandleAutoCommands()
+                self.Tick()
                 time.sleep(1)
             except Exception as e:
                 logger.error("Exception in 'run': {}".format(e))
                 traceback_str = traceback.format_exc()
                 logger.error("Traceback: {}".format(traceback_str))
                 time.sleep(1)
-            
\ No newline at end of file
+        
+        self.Stop(self.StopSignal)
+        if getattr(self, "Server", None) is not None:
+            self.Server.should_exit = True
+        logger.info("Shutdown finished, exit")
+        sys.exit(0)
@@ -0,0 +1,157 @@
+from utils import handle_exceptions_for_methods, logger
+import multiprocessing
+import datetime
+import zlib
+import time
+
+@handle_exceptions_for_methods
+class CounterTable:
+    # Fixed size open addressing table of float counters in shared memory. It is created before
+    # any command process is forked, so every process sees and updates the same counters.
+    # Slot layout: [key, field_0, field_1, ...], key 0 marks an empty slot.
+    def __init__(self,
+                 capacity: int,
+                 fields: int,
+                 probes: int=8):
+        self.capacity = capacity
+        self.width = fields + 1
+        self.probes = probes
+        self.data = multiprocessing.RawArray("d", capacity * self.width)
+
+    def locate(self,
+               key: str):
+        # Caller holds the lock. Returns the offset of the first field of the slot for `key`,
+        # evicting the home slot when every probed slot is taken by other keys.
+        hashed = zlib.crc32(key.encode()) + 1
+        home = hashed % self.capacity
+        for i in range(self.probes):
+            offset = ((home + i) % self.capacity) * self.width
+            if self.data[offset] == hashed:
+                return offset + 1
+            if self.data[offset] == 0:
+                self.data[offset] = hashed
+                return offset + 1
+        offset = home * self.width
+        self.data[offset] = hashed
+        for i in range(1, self.width):
+            self.data[offset + i] = 0
+        return offset + 1
+
+@handle_exceptions_for_methods
+class AdmissionController:
+    def __init__(self,
+                 bot,
+                 user: dict={},
+                 group: dict={},
+                 commands: dict={},
+                 daily_quota: dict={},
+                 notice: bool=True,
+                 notice_interval: float=60,
+                 capacity: int=4096):
+        self.bot = bot
+        self.user = user
+        self.group = group
+        self.commands = commands
+        self.daily_quota = daily_quota
+        self.notice = notice
+        self.notice_interval = notice_interval
+        self.enabled = bool(user or group or commands or daily_quota)
+        self.lock = multiprocessing.Lock()
+        # [tokens, last_refill]
+        self.buckets = CounterTable(capacity, 2)
+        # [day, tokens, images]
+        self.usage = CounterTable(capacity, 3)
+        self.last_notice = {}
+
+    def bucket_rules(self,
+                     cmd_name: str,
+                     sender_id: int,
+                     group_id: int|str):
+        rules = []
+        if self.user:
+            rules.append(("user:{}".format(sender_id), self.user))
+        if self.group and group_id:
+            rules.append(("group:{}".format(group_id), self.group))
+        command_rule = self.commands.get(cmd_name, {})
+        if "rate" in command_rule:
+            rules.append(("command:{}".format(cmd_name), command_rule))
+        return rules
+
+    def refill(self,
+               offset: int,
+               rule: dict,
+               now: float):
+        data = self.buckets.data
+        burst = rule.get("burst", 1)
+        if data[offset + 1] == 0:
+            data[offset] = burst
+        else:
+            data[offset] = min(burst, data[offset] + (now - data[offset + 1]) * rule["rate"])
+        data[offset + 1] = now
+        return data[offset]
+
+    def usage_offset(self,
+                     target_id: int|str):
+        # Caller holds the lock, counters of a previous day are reset on first access
+        offset = self.usage.locate("target:{}".format(target_id))
+        today = datetime.date.today().toordinal()
+        if self.usage.data[offset] != today:
+            self.usage.data[offset] = today
+            self.usage.data[offset + 1] = 0
+            self.usage.data[offset + 2] = 0
+        return offset
+
+    def Admit(self,
+              cmd_name: str,
+              sender_id: int,
+              group_id: int|str,
+              target_id: int|str):
+        if not self.enabled or self.bot.is_admin(sender_id):
+            return True, ""
+        now = time.time()
+        with self.lock:
+            cost = self.commands.get(cmd_name, {}).get("cost", "")
+            if cost in self.daily_quota:
+                offset = self.usage_offset(target_id)
+                used = self.usage.data[offset + (1 if cost == "tokens" else 2)]
+                if used >= self.daily_quota[cost]:
+                    return False, "今日额度已用完 ({}: {:.0f}/{})".format(cost, used, self.daily_quota[cost])
+
+            offsets = []
+            for key, rule in self.bucket_rules(cmd_name, sender_id, group_id):
+                offset = self.buckets.locate(key)
+                if self.refill(offset, rule, now) < 1:
+                    return False, "请求过于频繁, 请稍后再试"
+                offsets.append(offset)
+            for offset in offsets:
+                self.buckets.data[offset] -= 1
+        return True, ""
+
+    def Charge(self,
+               target_id: int|str,
+               tokens: int=0,
+               images: int=0):
+        if not self.enabled:
+            return
+        with self.lock:
+            offset = self.usage_offset(target_id)
+            self.usage.data[offset + 1] += tokens or 0
+            self.usage.data[offset + 2] += images or 0
+        logger.debug("Charge [{}] with {} tokens and {} images".format(target_id, tokens, images))
+
+    def Usage(self,
+              target_id: int|str):
+        with self.lock:
+            offset = self.usage_offset(target_id)
+            return {"tokens": self.usage.data[offset + 1], "images": self.usage.data[offset + 2]}
+
+    def should_notice(self,
+                      sender_id: int):
+        # Runs in the receiver thread only, a plain dict is enough
+        if not self.notice:
+            return False
+        now = time.time()
+        if now - self.last_notice.get(sender_id, 0) < self.notice_interval:
+            return False
+        self.last_notice[sender_id] = now
+        return True
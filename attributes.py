@@ -0,0 +1,112 @@
+from utils import handle_exceptions
+import json
+
+EDITABLE_SECTIONS = ["params", "extra_params"]
+# Keys that are read rather than edited, they and everything under them are not indexed
+HIDDEN_KEYS = ["extra_params.attributes"]
+# Keys a dict must keep when it is replaced as a whole
+REQUIRED_KEYS = {"extra_params.auto_params": ["run", "min_execution_interval"]}
+TYPE_NAMES = {bool: "布尔值", int: "整数", float: "浮点数", str: "字符串", list: "列表", dict: "字典"}
+
+class AttributeSpec:
+    __slots__ = ("path", "type", "choices", "minimum", "maximum", "required")
+
+    def __init__(self,
+                 path: tuple,
+                 type: type,
+                 choices: list=None,
+                 minimum: float=None,
+                 maximum: float=None,
+                 required: list=None):
+        self.path = path
+        self.type = type
+        self.choices = choices
+        self.minimum = minimum
+        self.maximum = maximum
+        self.required = required
+
+    def Parse(self,
+              text: str):
+        # Returns (value, error), error is a message for the user
+        if self.type is bool:
+            if text.lower() not in ["true", "false"]:
+                return None, "布尔值只能为 True 或 False"
+            value = text.lower() == "true"
+        elif self.type in [int, float]:
+            try:
+                value = self.type(text)
+            except ValueError:
+                return None, "{}格式错误".format(TYPE_NAMES[self.type])
+        elif self.type in [list, dict]:
+            try:
+                value = json.loads(text)
+            except json.JSONDecodeError:
+                return None, "{}需要 JSON 格式".format(TYPE_NAMES[self.type])
+            if not isinstance(value, self.type):
+                return None, "需要{}".format(TYPE_NAMES[self.type])
+        elif self.type is str:
+            value = text
+        else:
+            return None, "未知属性类型"
+
+        if self.required and any(key not in value for key in self.required):
+            return None, "缺少必需的键 {}".format([key for key in self.required if key not in value])
+        if self.choices is not None and value not in self.choices:
+            return None, "可选值为 {}".format(self.choices)
+        if self.minimum is not None and value < self.minimum:
+            return None, "不能小于 {}".format(self.minimum)
+        if self.maximum is not None and value > self.maximum:
+            return None, "不能大于 {}".format(self.maximum)
+        return value, ""
+
+def FormatPath(path: tuple,
+               sep: str=".",
+               rep: str="§"):
+    return sep.join(str(key).replace(sep, rep) for key in path)
+
+def ParsePath(key: str,
+              sep: str=".",
+              rep: str="§"):
+    return tuple(part.replace(rep, sep) for part in key.split(sep))
+
+@handle_exceptions
+def BuildAttributeIndex(cmd_dict: dict):
+    # Maps "params.x" style keys to their spec, for every value under the editable sections.
+    # The sections themselves are not editable as a whole.
+    # Constraints come from `extra_params.attributes`, e.g. {"params.temperature": {"minimum": 0}}
+    constraints = cmd_dict.get("extra_params", {}).get("attributes", {})
+    index = {}
+
+    def walk(value, path):
+        key = FormatPath(path)
+        if key in HIDDEN_KEYS:
+            return
+        if type(value) in TYPE_NAMES and len(path) > 1:
+            options = {"required": REQUIRED_KEYS.get(key, None), **constraints.get(key, {})}
+            index[key] = AttributeSpec(path, type(value), **options)
+        if isinstance(value, dict):
+            for child_key, child_value in value.items():
+                walk(child_value, path + (child_key,))
+
+    for section in EDITABLE_SECTIONS:
+        if isinstance(cmd_dict.get(section), dict):
+            walk(cmd_dict[section], (section,))
+    return index
+
+@handle_exceptions
+def GetPath(cmd_dict: dict,
+            path: tuple):
+    value = cmd_dict
+    for key in path:
+        value = value[key]
+    return value
+
+@handle_exceptions
+def SetPath(cmd_dict: dict,
+            path: tuple,
+            value):
+    current = cmd_dict
+    for key in path[:-1]:
+        current = current[key]
+    current[path[-1]] = value
+    return cmd_dict
@@ -0,0 +1,127 @@
+from utils import handle_exceptions_for_methods, logger
+from collections import deque
+import threading
+import time
+
+# Messages that must not be merged with others, they close the batch before them
+BATCH_BARRIERS = ["clear"]
+
+class Batch:
+    __slots__ = ("events", "opened", "closed")
+
+    def __init__(self,
+                 opened: float):
+        self.events = []
+        self.opened = opened
+        self.closed = False
+
+@handle_exceptions_for_methods
+class CommandBatcher:
+    # Messages for a batched command that reach one target within `batch_window` seconds are
+    # merged into one multi-speaker turn and handled by one process. At most one process per
+    # (command, target) runs at a time, the next batch starts after it finished, so reads and
+    # writes of per-target state such as chat history are serial.
+    def __init__(self,
+                 bot):
+        self.bot = bot
+        self.condition = threading.Condition()
+        self.windows = {}
+        self.pending = {}
+        self.inflight = {}
+        self.draining = False
+        self.thread = None
+
+    def Configure(self,
+                  windows: dict):
+        # `windows` maps command name to (batch_window, batch_max)
+        with self.condition:
+            self.windows = windows
+
+    def is_batched(self,
+                   cmd_name: str):
+        return cmd_name in self.windows
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="command-batcher", daemon=True)
+        self.thread.start()
+
+    def Add(self,
+            event):
+        key = (event.cmd_name, event.target_id)
+        now = time.time()
+        with self.condition:
+            _, batch_max = self.windows.get(event.cmd_name, (0, 1))
+            batches = self.pending.setdefault(key, deque())
+            if event.argument.strip() in BATCH_BARRIERS:
+                if batches and not batches[-1].closed:
+                    batches[-1].closed = True
+                batches.append(Batch(now))
+                batches[-1].closed = True
+            elif not batches or batches[-1].closed:
+                batches.append(Batch(now))
+            batch = batches[-1]
+            batch.events.append(event)
+            if len(batch.events) >= batch_max:
+                batch.closed = True
+            self.condition.notify_all()
+
+    def Merge(self,
+              events: list):
+        if len(events) == 1:
+            return events[0].argument
+        return "\n".join("{}: {}".format(event.nickname or event.sender_id, event.argument) for event in events)
+
+    def is_running(self,
+                   key: tuple):
+        process = self.inflight.get(key, None)
+        return process is not None and process.is_alive()
+
+    def flush(self,
+              now: float):
+        # Caller holds the condition. Starts every batch that is due and returns how long to wait
+        # before the next one is.
+        waits = []
+        self.inflight = {key: process for key, process in self.inflight.items() 
+                         if process is not None and process.is_alive()}
+        for key in list(self.pending.keys()):
+            batches = self.pending[key]
+            if self.is_running(key):
+                # Process liveness is polled, there is nothing to be notified by
+                waits.append(0.1)
+                continue
+            batch = batches[0]
+            due = batch.opened + self.windows.get(key[0], (0, 1))[0]
+            if not (batch.closed or self.draining or now >= due):
+                waits.append(due - now)
+                continue
+            batches.popleft()
+            event = batch.events[-1]
+            if len(batch.events) > 1:
+                logger.info("Merge {} messages for '{}' of [{}:{}]".format(
+                            len(batch.events), key[0], event.message_type, event.target_id))
+            self.inflight[key] = self.bot.StartCommand(event, self.Merge(batch.events))
+            if batches:
+                waits.append(0.1)
+            else:
+                del self.pending[key]
+        return min(waits) if waits else None
+
+    def run(self):
+        with self.condition:
+            while True:
+                wait = self.flush(time.time())
+                self.condition.wait(wait)
+
+    def Drain(self,
+              deadline: float):
+        # Sends what is pending without waiting for the windows, the started processes are
+        # tracked by the shutdown coordinator like any other command
+        with self.condition:
+            self.draining = True
+            self.condition.notify_all()
+            while self.pending and time.time() < deadline:
+                self.condition.wait(min(0.1, max(0, deadline - time.time())))
+            abandoned = ["{} message(s) for '{}' of {}".format(len(batch.events), cmd_name, target_id)
+                         for (cmd_name, target_id), batches in self.pending.items() for batch in batches]
+            self.pending = {}
+        return abandoned
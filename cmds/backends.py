@@ -0,0 +1,201 @@
+from utils import handle_exceptions_for_methods, handle_exceptions, logger
+import threading
+import requests
+import queue
+import json
+import time
+
+OPENAI_URL = "https://api.openai.com/v1"
+
+@handle_exceptions
+def Percentile(values: list,
+               q: float):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+@handle_exceptions_for_methods
+class BackendGroup:
+    # Several endpoints serving the same command. A request goes to the backend with the lowest
+    # median latency, a second one is started on the next backend when the first has not answered
+    # after `hedge_percentile` of its usual latency, and a failed request fails over right away.
+    # The first answer wins, the others are left to their own timeouts in daemon threads.
+    # A backend whose error rate over the last `window` requests reaches `breaker_error_rate` is
+    # skipped for `breaker_cooldown` seconds, then a single request decides whether it is back.
+    # `stats` and `lock` are shared by the command processes, e.g. a Manager dict and lock.
+    def __init__(self,
+                 name: str,
+                 backends: list,
+                 stats: dict=None,
+                 lock=None,
+                 timeout: float=60,
+                 hedge: bool=True,
+                 hedge_percentile: float=0.9,
+                 hedge_delay: float=3,
+                 min_samples: int=5,
+                 window: int=20,
+                 breaker_error_rate: float=0.5,
+                 breaker_min_requests: int=4,
+                 breaker_cooldown: float=30):
+        self.name = name
+        # Statistics and breakers are kept by name, two backends must never share one
+        self.backends = []
+        for i, backend in enumerate(backends):
+            name = backend.get("url", OPENAI_URL)
+            if "model" in backend:
+                name = "{}@{}".format(backend["model"], name)
+            name = backend.get("name", name)
+            if name in [other["name"] for other in self.backends]:
+                logger.warning("Backend name {} of {} is not unique, use {}#{}".format(name, self.name, name, i))
+                name = "{}#{}".format(name, i)
+            self.backends.append({**backend, "name": name})
+        self.stats = stats if stats is not None else {}
+        self.lock = lock if lock is not None else threading.Lock()
+        self.timeout = timeout
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_delay = hedge_delay
+        self.min_samples = min_samples
+        self.window = window
+        self.breaker_error_rate = breaker_error_rate
+        self.breaker_min_requests = breaker_min_requests
+        self.breaker_cooldown = breaker_cooldown
+
+    def key(self,
+            backend: dict):
+        return "{}/{}".format(self.name, backend["name"])
+
+    def get_stats(self,
+                  backend: dict):
+        return self.stats.get(self.key(backend), None) or \
+               {"latencies": [], "outcomes": [], "opened": 0, "requests": 0, "errors": 0, "hedges": 0}
+
+    def Record(self,
+               backend: dict,
+               ok: bool,
+               latency: float,
+               hedged: bool=False):
+        now = time.time()
+        with self.lock:
+            stats = self.get_stats(backend)
+            stats["requests"] += 1
+            stats["hedges"] += hedged
+            stats["outcomes"] = (stats["outcomes"] + [ok])[-self.window:]
+            if ok:
+                stats["latencies"] = (stats["latencies"] + [latency])[-self.window:]
+                if stats["opened"]:
+                    logger.info("Backend {} recovered, close its breaker".format(self.key(backend)))
+                    stats["opened"] = 0
+                    stats["outcomes"] = [ok]
+            else:
+                stats["errors"] += 1
+                outcomes = stats["outcomes"]
+                error_rate = outcomes.count(False) / len(outcomes)
+                if stats["opened"] or (len(outcomes) >= self.breaker_min_requests and
+                                       error_rate >= self.breaker_error_rate):
+                    if not stats["opened"]:
+                        logger.warning("Backend {} error rate {:.0%}, open its breaker".format(
+                                       self.key(backend), error_rate))
+                    stats["opened"] = now
+            self.stats[self.key(backend)] = stats
+
+    def Rank(self):
+        # Backends without samples rank first so that every backend gets measured
+        now = time.time()
+        ranked = []
+        for i, backend in enumerate(self.backends):
+            stats = self.get_stats(backend)
+            if stats["opened"] and now - stats["opened"] < self.breaker_cooldown:
+                continue
+            latencies = stats["latencies"]
+            ranked.append((Percentile(latencies, 0.5) if latencies else 0, i, backend))
+        return [backend for *_, backend in sorted(ranked, key=lambda item: item[:2])]
+
+    def HedgeDelay(self,
+                   backend: dict):
+        latencies = self.get_stats(backend)["latencies"]
+        if len(latencies) < self.min_samples:
+            return self.hedge_delay
+        return Percentile(latencies, self.hedge_percentile)
+
+    def Call(self,
+             send):
+        # `send(backend, timeout)` returns the result or raises, returns (result, error)
+        deadline = time.time() + self.timeout
+        candidates = self.Rank()
+        if not candidates:
+            return None, "{} 的所有后端均暂不可用".format(self.name)
+        results = queue.Queue()
+
+        def attempt(backend, hedged):
+            start = time.time()
+            try:
+                result, ok = send(backend, max(0.1, deadline - start)), True
+            except Exception as e:
+                result, ok = e, False
+            self.Record(backend, ok, time.time() - start, hedged)
+            results.put((backend, ok, result))
+
+        def launch(hedged=False):
+            backend = candidates.pop(0)
+            logger.debug("{} request to backend {}".format("Hedge" if hedged else "Send", self.key(backend)))
+            threading.Thread(target=attempt, args=(backend, hedged), daemon=True).start()
+            return time.time() + self.HedgeDelay(backend)
+
+        hedge_at = launch()
+        # `slots` is how many requests should be in flight, a failed one is replaced by the next backend
+        running, slots, hedged, errors = 1, 1, not self.hedge, []
+        while running and time.time() < deadline:
+            wait = deadline - time.time()
+            if not hedged and candidates:
+                wait = min(wait, max(0, hedge_at - time.time()))
+            try:
+                backend, ok, result = results.get(timeout=wait)
+            except queue.Empty:
+                if not hedged and candidates and time.time() >= hedge_at:
+                    hedged = True
+                    running, slots = running + 1, 2
+                    launch(hedged=True)
+                continue
+            running -= 1
+            if ok:
+                return result, ""
+            logger.warning("Backend {} failed: {}".format(self.key(backend), result))
+            errors.append("{}: {}".format(backend["name"], result))
+            if candidates and running < slots:
+                running += 1
+                hedge_at = launch()
+        if running:
+            errors.append("超时 {}s".format(self.timeout))
+        return None, "; ".join(errors)
+
+@handle_exceptions
+def CreateBackendGroup(bot,
+                       name: str,
+                       backends: list,
+                       options: dict={}):
+    # Statistics live in the bot's Manager so that they outlast the command process
+    return BackendGroup(name, backends, bot.BackendStats, bot.BACKEND_LOCK, **options)
+
+def SendChatCompletion(backend: dict,
+                       timeout: float,
+                       messages: list):
+    # Any OpenAI compatible endpoint, returns (content, total_tokens)
+    r = requests.post(backend.get("url", OPENAI_URL).rstrip("/") + "/chat/completions",
+                      headers={"Authorization": "Bearer {}".format(backend.get("api_key", ""))},
+                      json={"model": backend.get("model", "gpt-3.5-turbo"), "messages": messages},
+                      timeout=timeout)
+    r.raise_for_status()
+    response = r.json()
+    return response["choices"][0]["message"]["content"], response.get("usage", {}).get("total_tokens", 0)
+
+def SendTranslation(backend: dict,
+                    timeout: float,
+                    text: str,
+                    source_lang: str,
+                    target_lang: str):
+    # DeepLX style endpoint, returns (translation, alternatives)
+    postdata = json.dumps({"text": text, "source_lang": source_lang, "target_lang": target_lang})
+    r = requests.post(backend["url"], data=postdata, timeout=timeout)
+    r.raise_for_status()
+    response = r.json()
+    return response["data"], response.get("alternatives", [])
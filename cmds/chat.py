@@ -1,10 +1,5 @@
+from cmds.backends import CreateBackendGroup, SendChatCompletion, SendTranslation
 from utils import handle_exceptions, logger, String2Dict
-import traceback
-import requests
-import openai
-import json
-
-client = openai.OpenAI(api_key="")
 
 @handle_exceptions
 def CreateChatHistory(bot,
@@ -37,22 +32,29 @@ def GenerateTargetHistory(bot,
     return target_history, chat_history
 
 @handle_exceptions
-def ToOpenAI(api_key: str, 
-             chat_history: list, 
-             model: str="gpt-3.5-turbo"):
-    client = openai.OpenAI(api_key=api_key)
-    try: 
-        r = client.chat.completions.create(model=model, messages=chat_history)
-        logger.debug("Finish completion: {}".format(r))
-        chat_history.append({"role": "assistant", "content": r.choices[0].message.content})
-        return chat_history, r.usage.total_tokens
-    
-    except Exception as e:
-        traceback_str = traceback.format_exc()
-        return_str = "Exception in `ToOpenAI`: {}\n".format(e) + \
-                     "Traceback: {}".format(traceback_str)
-        logger.error(return_str)
-        return return_str, None
+def ToBackends(bot, 
+               cmd_name: str, 
+               chat_history: list, 
+               backends: list, 
+               backend_options: dict={}):
+    group = CreateBackendGroup(bot, cmd_name, backends, backend_options)
+    result, error = group.Call(lambda backend, timeout: SendChatCompletion(backend, timeout, chat_history)) or \
+                    (None, "后端调用异常")
+    if result is None:
+        logger.error("Chat completion of {} failed: {}".format(cmd_name, error))
+        return "对话失败喵, {}".format(error), None
+    content, total_tokens = result
+    logger.debug("Finish completion: {}".format(content))
+    chat_history.append({"role": "assistant", "content": content})
+    return chat_history, total_tokens
+
+@handle_exceptions
+def ChatBackends(api_key: str, 
+                 model: str, 
+                 backends: list):
+    # Without `backends` the command talks to OpenAI with its own `api_key` and `model`,
+    # entries of `backends` default to them as well
+    return [{"api_key": api_key, "model": model, **backend} for backend in backends or [{}]]
 
 @handle_exceptions
 def UpdateChatHistory(bot, 
@@ -73,6 +75,8 @@ def UpdateChatHistory(bot,
         logger.debug("Chat History for {} cleared!".format(target))
     
     with bot.COMMAND_LOCK:
+        # Journaled first, a change that is applied must never be missing from the journal
+        bot.State.Append({"op": "chat", "cmd": cmd_name, "target": target, "history": target_history})
         chat_history[target] = target_history
         cmd_dict["chat_history"] = chat_history
         commands[cmd_name] = cmd_dict
@@ -81,65 +85,97 @@ def UpdateChatHistory(bot,
     
     return message
 
+@handle_exceptions
+def QuoteMessage(message: str, 
+                 quoted_message=None):
+    # Puts the message a user replied to in front of their own, taken from the bot's message history
+    if quoted_message is None or not quoted_message.text:
+        return message
+    # Messages sent by the bot itself carry no nickname
+    return "引用 {} 的消息: {}\n{}".format(quoted_message.nickname or "你", quoted_message.text, message)
+
 @handle_exceptions
 def Chat(bot, 
          message: str, 
-         api_key: str,
          target_id: int, 
          cmd_name: str, 
+         api_key: str="",
          model: str="gpt-3.5-turbo", 
          chat_history: dict={}, 
+         quoted_message=None, 
+         backends: list=[], 
+         backend_options: dict={}, 
          ):
     target = str(target_id)
     if message == "clear":
         UpdateChatHistory(bot, target, cmd_name, clear=True)
         return "已清空"
-    openai.api_key = api_key
+    message = QuoteMessage(message, quoted_message)
     logger.debug("Chat with message: {}".format(message))
     target_history, chat_history = GenerateTargetHistory(bot, cmd_name, message, target, chat_history)
-    new_target_history, total_tokens = ToOpenAI(api_key, chat_history=target_history, model=model)
+    new_target_history, total_tokens = ToBackends(bot, cmd_name, target_history, 
+                                                  ChatBackends(api_key, model, backends), backend_options)
     if total_tokens is None:
         return new_target_history
+    bot.Admission.Charge(target_id, tokens=total_tokens)
     return UpdateChatHistory(bot, target, cmd_name, new_target_history, chat_history) + \
            f"\n|当前累计 token: {total_tokens}"
 
 @handle_exceptions
 def ConditionalChat(bot, 
                     message: str, 
-                    api_key: str,
                     target_id: int, 
                     cmd_name: str, 
+                    api_key: str="",
                     model: str="gpt-3.5-turbo", 
                     chat_history: dict={}, 
-                    conditional_history: list=[]):
+                    conditional_history: list=[], 
+                    quoted_message=None, 
+                    backends: list=[], 
+                    backend_options: dict={}):
     target = str(target_id)
     if message == "clear":
         UpdateChatHistory(bot, target, cmd_name, clear=True)
         return "已清空喵"
+    message = QuoteMessage(message, quoted_message)
     target_history, chat_history = GenerateTargetHistory(bot, cmd_name, message, target, chat_history)
     target_history = conditional_history + target_history
-    new_target_history, total_tokens = ToOpenAI(api_key, chat_history=target_history, model=model)
-    new_target_history = new_target_history[len(conditional_history):]
+    new_target_history, total_tokens = ToBackends(bot, cmd_name, target_history, 
+                                                  ChatBackends(api_key, model, backends), backend_options)
     if total_tokens is None:
         return new_target_history
+    new_target_history = new_target_history[len(conditional_history):]
+    bot.Admission.Charge(target_id, tokens=total_tokens)
     return UpdateChatHistory(bot, target, cmd_name, new_target_history, chat_history) + \
            f"\n|当前累计 token: {total_tokens}"
            
 @handle_exceptions
-def Translate(api_url: str,
+def Translate(bot, 
+              cmd_name: str, 
               message: str, 
+              api_url: str="",
               source_lang: str="auto", 
-              target_lang: str="EN"):
+              target_lang: str="EN", 
+              quoted_message=None, 
+              backends: list=[], 
+              backend_options: dict={}):
     cfg = String2Dict(message, default_key="text")
-    text = cfg["text"]
+    text = cfg.get("text", "").strip()
+    if not text and quoted_message is not None:
+        # "Translate|" in reply to a message translates that message
+        text = quoted_message.text
+    if not text:
+        return "没有要翻译的内容喵"
     source_lang = cfg.get("source_lang", source_lang)
     target_lang = cfg.get("target_lang", target_lang)
-    postdata = json.dumps({"text": text, "source_lang": source_lang, "target_lang": target_lang})
     logger.debug("Translating [{}] from [{}] to [{}]".format(text, source_lang, target_lang))
     
-    r = requests.post(api_url, data=postdata)
-    logger.debug("Translation response: {}".format(r.text))
-    if r.status_code == 200:
-        return r.json()["data"] + "\n-----\n" + "\n-----\n".join(r.json()["alternatives"])
-    else:
-        return "翻译失败喵, {}".format(r.text)
\ No newline at end of file
+    group = CreateBackendGroup(bot, cmd_name, backends or [{"url": api_url}], backend_options)
+    result, error = group.Call(lambda backend, timeout: SendTranslation(backend, timeout, text, 
+                                                                        source_lang, target_lang)) or \
+                    (None, "后端调用异常")
+    if result is None:
+        return "翻译失败喵, {}".format(error)
+    translation, alternatives = result
+    logger.debug("Translation response: {} {}".format(translation, alternatives))
+    return translation + "\n-----\n" + "\n-----\n".join(alternatives)
\ No newline at end of file
@@ -6,6 +6,9 @@ import numpy as np
 import requests
 import traceback
 import random
+import shutil
+import time
+import os
 
 MAX_SEED = np.iinfo(np.int32).max
 TOKENIZER = CLIPTokenizer.from_pretrained("openai/clip-vit-large-patch14")
@@ -112,7 +115,9 @@ def Text2Image(bot,
                custom_height: int=1024, 
                notice_postdata: bool=False,
                notice: bool=True, 
-               return_url: bool=True):
+               return_url: bool=True, 
+               charge: bool=True, 
+               interactive: bool=True):
     postdata = PreprocessRawinput(message, negative_prompt, quality, style, 
                                   quality_dict, style_dict, custom_width, custom_height, return_url)
     if not isinstance(postdata, dict):
@@ -124,10 +129,21 @@ def Text2Image(bot,
         return postdata, "text"
     logger.debug("Get postdata: {}".format(postdata))
     
-    r = requests.post(api_url, json=postdata)
+    # The reservoir refill only generates while no interactive request waits on the backend
+    if interactive:
+        with bot.InteractiveJobs.get_lock():
+            bot.InteractiveJobs.value += 1
+    try:
+        r = requests.post(api_url, json=postdata)
+    finally:
+        if interactive:
+            with bot.InteractiveJobs.get_lock():
+                bot.InteractiveJobs.value -= 1
     # r = requests.get("https://www.baidu.com/favicon.ico")
     if r.status_code == 200:
         logger.debug("Get image from {}".format(api_url))
+        if charge:
+            bot.Admission.Charge(target_id, images=1)
         if r.headers["Content-Type"] == "application/json":
             return r.json()["url"], "image"
         return SaveImage(r.content, save_dir, prefix), "image"
@@ -151,12 +167,105 @@ def AutoText2Image(bot,
                    custom_width: int=1024, 
                    custom_height: int=1024, 
                    notice: bool=False, 
-                   return_url: bool=True):
+                   return_url: bool=True, 
+                   reservoir_dir: str="", 
+                   reservoir_ttl: float=86400):
+    if reservoir_dir:
+        filepath = ClaimReservoirImage(reservoir_dir, save_dir, reservoir_ttl)
+        if filepath:
+            return filepath, "image"
+        logger.info("Image reservoir {} is empty, generate on demand".format(reservoir_dir))
     prompt = f"prompt={prompt}"
     filepath, type = Text2Image(bot, target_id, message_type, prompt, api_url, save_dir, 
                                 prefix, negative_prompt, quality, style, quality_dict, style_dict, 
-                                custom_width, custom_height, notice=False, return_url=return_url)
+                                custom_width, custom_height, notice=False, return_url=return_url, 
+                                charge=False, interactive=False)
     if type == "image":
         return filepath, type
     if notice:
-        bot.SendMessage(filepath, message_type, target_id, "text")
\ No newline at end of file
+        bot.SendMessage(filepath, message_type, target_id, "text")
+
+@handle_exceptions
+def ReservoirImages(reservoir_dir: str, 
+                    reservoir_ttl: float):
+    # Oldest first, entries older than `reservoir_ttl` are removed on the way, and so are claims
+    # left behind by a process that died while moving its image
+    if not os.path.exists(reservoir_dir):
+        return []
+    images = []
+    now = time.time()
+    for entry in os.scandir(reservoir_dir):
+        if not entry.is_file():
+            continue
+        if entry.name.startswith(".claimed_"):
+            # Renaming keeps the mtime, the ctime tells when the image was claimed
+            if now - entry.stat().st_ctime > reservoir_ttl:
+                os.remove(entry.path)
+                logger.info("Remove stale claim {} from reservoir".format(entry.path))
+            continue
+        if entry.name.startswith("."):
+            continue
+        if now - entry.stat().st_mtime > reservoir_ttl:
+            os.remove(entry.path)
+            logger.info("Remove expired image {} from reservoir".format(entry.path))
+            continue
+        images.append((entry.stat().st_mtime, entry.path))
+    return [path for _, path in sorted(images)]
+
+@handle_exceptions
+def ClaimReservoirImage(reservoir_dir: str, 
+                        save_dir: str, 
+                        reservoir_ttl: float=86400):
+    for path in ReservoirImages(reservoir_dir, reservoir_ttl) or []:
+        claimed_path = os.path.join(reservoir_dir, ".claimed_{}_{}".format(os.getpid(), os.path.basename(path)))
+        try:
+            # Renaming is atomic, of two processes claiming the same image only one succeeds
+            os.rename(path, claimed_path)
+        except FileNotFoundError:
+            continue
+        os.makedirs(save_dir, exist_ok=True)
+        savepath = os.path.abspath(shutil.move(claimed_path, os.path.join(save_dir, os.path.basename(path))))
+        logger.info("Claim image {} from reservoir".format(savepath))
+        return savepath
+    return None
+
+@handle_exceptions
+def RefillImageReservoir(bot, 
+                         prompt: str, 
+                         api_url: str, 
+                         reservoir_dir: str, 
+                         negative_prompt: str, 
+                         quality: str, 
+                         style: str, 
+                         quality_dict: dict, 
+                         style_dict: dict, 
+                         custom_width: int=1024, 
+                         custom_height: int=1024, 
+                         prefix: str="reservoir", 
+                         buffer_size: int=4, 
+                         reservoir_ttl: float=86400):
+    # Auto command that keeps `buffer_size` images ready for AutoText2Image. It generates one image
+    # at a time and only while no interactive Text2Image request is waiting on the backend.
+    tmp_dir = os.path.join(reservoir_dir, ".tmp")
+    generated = 0
+    while len(ReservoirImages(reservoir_dir, reservoir_ttl) or []) < buffer_size:
+        if bot.InteractiveJobs.value > 0:
+            logger.debug("Backend busy with {} interactive jobs, pause refilling".format(bot.InteractiveJobs.value))
+            break
+        postdata = PreprocessRawinput(f"prompt={prompt}", negative_prompt, quality, style, 
+                                      quality_dict, style_dict, custom_width, custom_height, return_url=False)
+        if not isinstance(postdata, dict):
+            break
+        r = requests.post(api_url, json=postdata)
+        if r.status_code != 200:
+            logger.warning("Refill image reservoir failed! {}".format(r.text))
+            break
+        content = r.content
+        if r.headers["Content-Type"] == "application/json":
+            content = requests.get(r.json()["url"]).content
+        # Saved aside first, a half written file must never be claimed
+        tmp_path = SaveImage(content, tmp_dir, prefix)
+        os.replace(tmp_path, os.path.join(reservoir_dir, os.path.basename(tmp_path)))
+        generated += 1
+    if generated:
+        logger.info("Refill {} images into reservoir {}".format(generated, reservoir_dir))
@@ -1,12 +1,17 @@
-from utils import handle_exceptions, format_dict_keys, unformat_dict_keys, logger
+from utils import handle_exceptions, AtomicWrite, logger
+from attributes import GetPath, SetPath
 from omegaconf import OmegaConf
 from io import BytesIO
 from PIL import Image
 import subprocess
+import selectors
 import datetime
+import resource
 import random
 import psutil
+import codecs
 import signal
+import time
 import os
 
 @handle_exceptions
@@ -21,18 +26,18 @@ def CleanCache(bot):
 def SaveConfig(bot, 
                save_dir: str="./configs", 
                prefix: str="last"):
-    cfg = bot.get_config()
-    config = OmegaConf.create({"target": "OneBot.OneBot", 
-                               "params": cfg})
+    if bot.Shared:
+        # A hosted account is saved as part of the host config, the only one the host can start from
+        config = OmegaConf.create({"target": "host.OneBotHost", 
+                                   "params": bot.Shared.Host.get_config()})
+    else:
+        config = OmegaConf.create({"target": "OneBot.OneBot", 
+                                   "params": bot.get_config()})
     
-    if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
     savepath = os.path.join(save_dir, f"{prefix}.yaml")
-    if os.path.exists(savepath):
-        os.rename(savepath, os.path.join(save_dir, "{}_{}.yaml".format(prefix, 
-                                         datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S"))))
-    
-    OmegaConf.save(config, savepath)
+    if AtomicWrite(savepath, OmegaConf.to_yaml(config)) is None:
+        return "配置保存失败"
+    bot.State.Compact(bot.CaptureState)
     logger.info("Config saved to {}".format(savepath))
     return "配置已保存到 {}".format(savepath)
 
@@ -78,69 +83,229 @@ def CleanFileCache(retained: int,
     logger.info("Remove {} files from file cache".format(len(files)-retained))
     return "保留 {} 个文件".format(retained)
 
+@handle_exceptions
+def Welcome(event, 
+            welcome: str="欢迎新人!"):
+    return [event.user_id, welcome], ["at", "text"]
+
+@handle_exceptions
+def HandleAddRequest(bot, 
+                     event, 
+                     approve: bool=True, 
+                     remark: str="", 
+                     reason: str="", 
+                     notice_admin: bool=True):
+    if event.detail_type == "friend":
+        params = {"flag": event.data["flag"], "approve": approve, "remark": remark}
+        bot.CallAPI("set_friend_add_request", params)
+    elif event.detail_type == "group":
+        params = {"flag": event.data["flag"], "sub_type": event.sub_type, "approve": approve, "reason": reason}
+        bot.CallAPI("set_group_add_request", params)
+    logger.info("{} {} request from {}".format("Approve" if approve else "Reject", event.key, event.user_id))
+    if notice_admin:
+        bot.SendMessage("已{} {} 的{}请求: {}".format("同意" if approve else "拒绝", event.user_id, 
+                                                  "好友" if event.detail_type == "friend" else "加群", 
+                                                  event.data.get("comment", "")), 
+                        "private", bot.AdminID, "text")
+
 @handle_exceptions
 def ChangeAttribute(bot, 
                     message: str):
-    show = False
-    if message.endswith("|-s"):
-        message = message[:-3]
-        show = True
-    key, value = message.split("=", 1)
-    cmd_name, cmd_key = key.split(".", 1)
-    if cmd_name not in bot.Commands.keys():
-        return "未知命令 {}".format(cmd_name)
-    commands = bot.Commands
-    cmd_dict = commands[cmd_name]
-    formatted_cmd_dict = format_dict_keys(cmd_dict)
-    logger.debug("Formatted commands: {}".format(formatted_cmd_dict.keys()))
-    logger.debug("Received key: {}, value: {} for command {}".format(cmd_key, value, cmd_name))
-    if cmd_key not in formatted_cmd_dict:
-        return "未找到属性 {}".format(cmd_key)
-    if show:
-        return "命令 {} 的属性 {} 为 {}".format(cmd_name, cmd_key, formatted_cmd_dict[cmd_key])
-    if isinstance(formatted_cmd_dict[cmd_key], bool):
-        if value.lower() in ["true", "false"]:
-            value = value.lower() == "true"
-            formatted_cmd_dict[cmd_key] = value
-        else:
-            return "布尔值只能为 True 或 False"
-    elif isinstance(formatted_cmd_dict[cmd_key], int):
-        try:
-            value = int(value)
-            formatted_cmd_dict[cmd_key] = value
-        except:
-            return "整数值格式错误"
-    elif isinstance(formatted_cmd_dict[cmd_key], float):
-        try:
-            value = float(value)
-            formatted_cmd_dict[cmd_key] = value
-        except:
-            return "浮点数值格式错误"
-    elif isinstance(formatted_cmd_dict[cmd_key], str):
-        formatted_cmd_dict[cmd_key] = value
-    else:
-        return "未知属性类型"
+    # One edit per line: `Cmd.params.x=value` sets, `Cmd.params.x|-s` shows
+    edits, replies, errors = {}, [], []
+    for line in [line.strip() for line in message.split("\n") if line.strip()]:
+        show = line.endswith("|-s")
+        if show:
+            line = line[:-3]
+        key, sep, value = line.partition("=")
+        if "." not in key or not (show or sep):
+            errors.append("格式错误 {}".format(line))
+            continue
+        cmd_name, cmd_key = key.split(".", 1)
+        if cmd_name not in bot.AttributeIndex:
+            errors.append("未知命令 {}".format(cmd_name))
+            continue
+        spec = bot.AttributeIndex[cmd_name].get(cmd_key, None)
+        if spec is None:
+            errors.append("未找到属性 {}".format(cmd_key))
+            continue
+        if show:
+            replies.append("命令 {} 的属性 {} 为 {}".format(cmd_name, cmd_key, 
+                                                        GetPath(bot.Commands[cmd_name], spec.path)))
+            continue
+        value, error = spec.Parse(value)
+        if error:
+            errors.append("命令 {} 的属性 {}: {}".format(cmd_name, cmd_key, error))
+            continue
+        edits.setdefault(cmd_name, []).append((cmd_key, spec, value))
+    logger.debug("Received attribute edits: {}".format(edits))
+    if errors:
+        return "\n".join(errors + (["未修改任何属性"] if edits else []))
     
-    unformatted_cmd_dict = unformat_dict_keys(formatted_cmd_dict)
     with bot.COMMAND_LOCK:
-        commands[cmd_name] = unformatted_cmd_dict
-        bot.Commands = commands
-    logger.info("Attribute {} for command {} changed to {}".format(cmd_key, cmd_name, value))
-        
-    return "命令 {} 的属性 {} 已修改为 {}".format(cmd_name, cmd_key, value)
+        for cmd_name, cmd_edits in edits.items():
+            cmd_dict = bot.Commands[cmd_name]
+            for cmd_key, spec, value in cmd_edits:
+                # Journaled first, a change that is applied must never be missing from the journal
+                bot.State.Append({"op": "set", "cmd": cmd_name, "path": list(spec.path), "value": value})
+                SetPath(cmd_dict, spec.path, value)
+            bot.Commands[cmd_name] = cmd_dict
+    
+    reindex = []
+    for cmd_name, cmd_edits in edits.items():
+        for cmd_key, spec, value in cmd_edits:
+            logger.info("Attribute {} for command {} changed to {}".format(cmd_key, cmd_name, value))
+            replies.append("命令 {} 的属性 {} 已修改为 {}".format(cmd_name, cmd_key, value))
+            if spec.type is dict:
+                reindex.append(cmd_name)
+        bot.PublishAttributeChanges(cmd_name, {cmd_key: value for cmd_key, _, value in cmd_edits})
+    if reindex:
+        bot.RequestControl("reindex", cmd_names=reindex)
+    
+    return "\n".join(replies)
 
 @handle_exceptions
 def TerminalCommand(bot, 
                     message: str, 
-                    sender_id: int):
+                    sender_id: int, 
+                    cmd_name: str, 
+                    interval: float=5, 
+                    max_bytes: int=64 * 1024, 
+                    timeout: float=600, 
+                    cpu_limit: int=60):
     logger.debug("Terminal command received: {}".format(message))
     
     if not bot.is_admin(sender_id):
         logger.warning("Unauthorized user {} tried to execute terminal command".format(sender_id))
         return "权限不足, 仅限管理员执行"
-    process = subprocess.Popen(message, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = process.communicate()
-    result = out.decode("utf-8") + err.decode("utf-8")
     
-    logger.debug("Terminal command executed, {}".format(result))
-    return result.strip("\n")
\ No newline at end of file
+    def limit_cpu():
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_limit, cpu_limit + 1))
+    
+    # A new session makes the shell and everything it starts one process group to cancel
+    process = subprocess.Popen(message, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, 
+                               start_new_session=True, preexec_fn=limit_cpu if cpu_limit else None)
+    job_id = process.pid
+    bot.TerminalJobs[job_id] = {"command": message, "started": time.time(), "sender_id": sender_id}
+    logger.info("Terminal job {} started: {}".format(job_id, message))
+    
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    selector = selectors.DefaultSelector()
+    selector.register(process.stdout, selectors.EVENT_READ)
+    pending, captured, truncated, timed_out = "", 0, False, False
+    start = last_flush = time.time()
+    version = time.time_ns()
+    try:
+        while True:
+            wake = min(last_flush + interval, start + timeout) if pending else start + timeout
+            # Wake at least every `interval` so that a silent job still sees new limits
+            if selector.select(max(0, min(wake, time.time() + interval) - time.time())):
+                data = os.read(process.stdout.fileno(), 65536)
+                if not data:
+                    break
+                # Keep draining the pipe after the cap so the command never blocks on a full pipe
+                kept = data[:max(0, max_bytes - captured)]
+                captured += len(kept)
+                truncated = truncated or len(kept) < len(data)
+                pending += decoder.decode(kept)
+            now = time.time()
+            if now >= start + timeout:
+                os.killpg(process.pid, signal.SIGKILL)
+                timed_out = True
+                break
+            if pending and now - last_flush >= interval:
+                bot.SendMessage("[任务 {}]\n{}".format(job_id, pending.strip("\n")), "private", bot.AdminID, "text")
+                pending, last_flush = "", now
+            # Limits changed with ChangeAttribute also apply to jobs that are already running
+            changes, version = bot.PollAttributeChanges(cmd_name, version) or ({}, version)
+            interval = changes.get("params.interval", interval)
+            max_bytes = changes.get("params.max_bytes", max_bytes)
+            timeout = changes.get("params.timeout", timeout)
+        returncode = process.wait()
+    finally:
+        selector.close()
+        process.stdout.close()
+        bot.TerminalJobs.pop(job_id, None)
+    
+    pending += decoder.decode(b"", final=True)
+    status = "超时已终止" if timed_out else "退出码 {}".format(returncode)
+    if truncated:
+        status += ", 输出超过 {} 字节已截断".format(max_bytes)
+    logger.debug("Terminal command executed, {}".format(status))
+    return "{}\n[任务 {} {}, 用时 {:.1f}s]".format(pending.strip("\n"), job_id, status, time.time() - start).strip("\n")
+
+@handle_exceptions
+def TerminalJobs(bot, 
+                 message: str, 
+                 sender_id: int):
+    if not bot.is_admin(sender_id):
+        logger.warning("Unauthorized user {} tried to manage terminal jobs".format(sender_id))
+        return "权限不足, 仅限管理员执行"
+    if message.startswith("kill"):
+        job_id = message[4:].strip()
+        if not job_id.isdigit() or int(job_id) not in bot.TerminalJobs.keys():
+            return "未知任务 {}".format(job_id)
+        os.killpg(int(job_id), signal.SIGTERM)
+        logger.info("Terminal job {} cancelled".format(job_id))
+        return "已取消任务 {}".format(job_id)
+    jobs = ["{}: {} (已运行 {:.0f}s)".format(job_id, job["command"], time.time() - job["started"]) 
+            for job_id, job in bot.TerminalJobs.items()]
+    return "\n".join(jobs) if jobs else "没有运行中的任务"
+
+@handle_exceptions
+def Reload(bot, 
+           message: str, 
+           sender_id: int):
+    if not bot.is_admin(sender_id):
+        logger.warning("Unauthorized user {} tried to reload".format(sender_id))
+        return "权限不足, 仅限管理员执行"
+    targets = [target.strip() for target in message.split(",") if target.strip()]
+    config = "config" in targets
+    modules = [target for target in targets if target != "config"]
+    bot.RequestControl("reload", reply_to=sender_id, modules=modules, config=config)
+    return "已请求重新加载 {}".format(", ".join(targets) if targets else "全部命令模块")
+
+@handle_exceptions
+def QuotaUsage(bot, 
+               target_id: int):
+    usage = bot.Admission.Usage(target_id)
+    quota = bot.Admission.daily_quota
+    return "今日用量: tokens {:.0f}/{}, 图片 {:.0f}/{}".format(usage["tokens"], quota.get("tokens", "不限"), 
+                                                        usage["images"], quota.get("images", "不限"))
+
+@handle_exceptions
+def AutoCommandStatus(bot, 
+                      message: str=""):
+    def format_time(timestamp):
+        if not timestamp:
+            return "无"
+        return datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+    
+    cmd_names = [message] if message else list(bot.Supervisor.Stats.keys())
+    results = []
+    for cmd_name in cmd_names:
+        if cmd_name not in bot.Supervisor.Stats:
+            results.append("未知自动命令 {}".format(cmd_name))
+            continue
+        stats = bot.Supervisor.Stats[cmd_name]
+        results.append("{}: 运行中 {} 个, 启动 {} 次, 成功 {} 次, 失败 {} 次 (连续 {} 次), 重启 {} 次\n"
+                       "上次成功: {}, 上次失败: {}, 上次耗时: {:.1f}s".format(
+                       cmd_name, stats["running"], stats["started"], stats["succeeded"], stats["failed"], 
+                       stats["consecutive_failures"], stats["restarts"], format_time(stats["last_success"]), 
+                       format_time(stats["last_failure"]), stats["last_duration"]))
+    return "\n".join(results) if results else "没有自动命令"
+
+@handle_exceptions
+def BackendStatus(bot, 
+                  message: str=""):
+    results = []
+    for key in sorted(bot.BackendStats.keys()):
+        if message and not key.startswith(message):
+            continue
+        stats = bot.BackendStats[key]
+        latencies = sorted(stats["latencies"])
+        median = "{:.2f}s".format(latencies[len(latencies) // 2]) if latencies else "无"
+        state = "熔断中" if stats["opened"] else "正常"
+        results.append("{}: {}, 请求 {} 次, 失败 {} 次, 对冲 {} 次, 延迟中位数 {}".format(
+                       key, state, stats["requests"], stats["errors"], stats["hedges"], median))
+    return "\n".join(results) if results else "没有后端统计"
@@ -0,0 +1,171 @@
+import json
+import re
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+POST_TYPE_PATTERN = re.compile(rb'"post_type"\s*:\s*"([a-z_]+)"')
+SELF_ID_PATTERN = re.compile(rb'"self_id"\s*:\s*(\d+)')
+# A reply starts with the quoted message and usually an @ of its sender before the actual text
+REPLY_PREFIX_PATTERN = re.compile(r'^\[CQ:reply,id=-?\d+\]\s*(\[CQ:at,qq=\d+\]\s*)?')
+DETAIL_TYPE_KEYS = {"message": "message_type", "notice": "notice_type", 
+                    "request": "request_type", "meta_event": "meta_event_type"}
+SUPPORTED_SEGMENTS = frozenset(["text", "face", "image", "record", "video", "at", "rps", "dice", "shake", 
+                                "poke", "share", "contact", "location", "music", "reply", "forward", "node",
+                                "xml", "json"])
+
+def PeekPostType(body: bytes):
+    # Every OneBot 11 event carries `post_type` as a plain string, finding it does not need a full decode
+    match = POST_TYPE_PATTERN.search(body)
+    return match.group(1).decode() if match else ""
+
+def PeekSelfID(body: bytes):
+    match = SELF_ID_PATTERN.search(body)
+    return int(match.group(1)) if match else 0
+
+class MessageEvent:
+    __slots__ = ("time", "self_id", "key", "message_id", "message_type", "sub_type", 
+                 "sender_id", "nickname", "group_id", "target_id", "raw_message", "message", 
+                 "reply_id", "cmd_name", "argument")
+    post_type = "message"
+
+    def __init__(self,
+                 time: int,
+                 self_id: int,
+                 message_id: int,
+                 message_type: str,
+                 sub_type: str,
+                 sender_id: int,
+                 nickname: str,
+                 group_id: int|str,
+                 raw_message: str,
+                 message: list,
+                 reply_id: int=0):
+        self.time = time
+        self.self_id = self_id
+        self.key = "message.{}".format(message_type)
+        self.message_id = message_id
+        self.message_type = message_type
+        self.sub_type = sub_type
+        self.sender_id = sender_id
+        self.nickname = nickname
+        self.group_id = group_id
+        self.target_id = group_id if message_type == "group" else sender_id
+        self.raw_message = raw_message
+        self.message = message
+        self.reply_id = reply_id
+        self.cmd_name = ""
+        self.argument = ""
+
+    def __repr__(self):
+        return "MessageEvent({})".format(", ".join("{}={!r}".format(key, getattr(self, key))
+                                                   for key in self.__slots__))
+
+def ParseMessageEvent(event: dict):
+    message = event.get("message", [])
+    if isinstance(message, str):
+        message = [{"type": "text", "data": {"text": message}}]
+    sender = event.get("sender", {})
+    reply_id = 0
+    if message and message[0]["type"] == "reply":
+        reply_id = int(message[0]["data"].get("id", 0))
+    return MessageEvent(time=event.get("time", 0),
+                        self_id=event.get("self_id", 0),
+                        message_id=event.get("message_id", 0),
+                        message_type=event.get("message_type", ""),
+                        sub_type=event.get("sub_type", ""),
+                        sender_id=sender.get("user_id", event.get("user_id", 0)),
+                        nickname=sender.get("nickname", ""),
+                        group_id=event.get("group_id", ""),
+                        raw_message=event.get("raw_message", ""),
+                        message=message,
+                        reply_id=reply_id)
+
+class Event:
+    # Notice, request and meta events. `key` is "<post_type>.<detail_type>[.<sub_type>]",
+    # handlers registered for any prefix of it receive the event.
+    __slots__ = ("time", "self_id", "post_type", "detail_type", "sub_type", "key", 
+                 "user_id", "group_id", "message_type", "target_id", "data")
+
+    def __init__(self,
+                 post_type: str,
+                 data: dict):
+        self.time = data.get("time", 0)
+        self.self_id = data.get("self_id", 0)
+        self.post_type = post_type
+        self.detail_type = data.get(DETAIL_TYPE_KEYS.get(post_type, ""), "")
+        self.sub_type = data.get("sub_type", "")
+        self.key = ".".join(part for part in [post_type, self.detail_type, self.sub_type] if part)
+        self.user_id = data.get("user_id", 0)
+        self.group_id = data.get("group_id", "")
+        self.message_type = "group" if self.group_id else "private"
+        self.target_id = self.group_id if self.group_id else self.user_id
+        self.data = data
+
+    def __repr__(self):
+        return "Event(key={!r}, data={!r})".format(self.key, self.data)
+
+def ParseEvent(event: dict):
+    post_type = event.get("post_type", "")
+    if post_type == "message":
+        return ParseMessageEvent(event)
+    return Event(post_type, event)
+
+class EventRouter:
+    # Handlers and middlewares are registered at startup and `Compile` folds them into one
+    # callable per post type, dispatching an event never looks at unrelated handlers.
+    # A middleware is called as `middleware(event, call_next)`.
+    def __init__(self):
+        self.handlers = {}
+        self.middlewares = []
+        self.chains = {}
+
+    def Register(self,
+                 key: str,
+                 handler):
+        self.handlers.setdefault(key, []).append(handler)
+
+    def Use(self,
+            middleware,
+            post_types: list=None):
+        self.middlewares.append((middleware, post_types))
+
+    def Compile(self):
+        chains = {}
+        for post_type in {key.split(".", 1)[0] for key in self.handlers}:
+            handlers = {key: handlers for key, handlers in self.handlers.items() 
+                        if key.split(".", 1)[0] == post_type}
+            chain = self.compile_dispatch(handlers)
+            for middleware, post_types in reversed(self.middlewares):
+                if post_types is None or post_type in post_types:
+                    chain = self.compile_middleware(middleware, chain)
+            chains[post_type] = chain
+        # Swapped in one assignment so a recompile never exposes a half built table
+        self.chains = chains
+        return set(chains)
+
+    def compile_dispatch(self,
+                         handlers: dict):
+        def dispatch(event):
+            parts = event.key.split(".")
+            for i in range(1, len(parts) + 1):
+                for handler in handlers.get(".".join(parts[:i]), []):
+                    handler(event)
+        return dispatch
+
+    def compile_middleware(self,
+                           middleware,
+                           call_next):
+        return lambda event: middleware(event, call_next)
+
+    def PostTypes(self):
+        return set(self.chains)
+
+    def Dispatch(self,
+                 event):
+        chain = self.chains.get(event.post_type, None)
+        if chain is not None:
+            chain(event)
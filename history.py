@@ -0,0 +1,98 @@
+from utils import handle_exceptions_for_methods, handle_exceptions
+from collections import OrderedDict, deque
+import threading
+
+class HistoryRecord:
+    # One message reduced to what commands look at, the full segment list is not kept
+    __slots__ = ("message_id", "message_type", "target_id", "time", "sender_id", "nickname",
+                 "text", "images", "reply_id")
+
+    def __init__(self,
+                 message_id: int,
+                 message_type: str,
+                 target_id: int|str,
+                 time: int,
+                 sender_id: int,
+                 nickname: str,
+                 text: str,
+                 images: tuple=(),
+                 reply_id: int=0):
+        self.message_id = message_id
+        self.message_type = message_type
+        self.target_id = target_id
+        self.time = time
+        self.sender_id = sender_id
+        self.nickname = nickname
+        self.text = text
+        self.images = images
+        self.reply_id = reply_id
+
+    def __repr__(self):
+        return "HistoryRecord({})".format(", ".join("{}={!r}".format(key, getattr(self, key))
+                                                    for key in self.__slots__))
+
+@handle_exceptions
+def CompactMessage(segments: list):
+    # Returns (text, images, reply_id) of a segment list
+    texts, images, reply_id = [], [], 0
+    for segment in segments:
+        data = segment.get("data", {})
+        if segment["type"] == "text":
+            texts.append(data.get("text", ""))
+        elif segment["type"] == "image":
+            image = data.get("url") or data.get("file", "")
+            if image and not image.startswith("base64://"):
+                images.append(image)
+        elif segment["type"] == "reply":
+            reply_id = int(data.get("id", 0))
+    return "".join(texts).strip(), tuple(images), reply_id
+
+@handle_exceptions_for_methods
+class MessageHistory:
+    # Ring buffer of the latest `size` messages of each target plus an index by message id.
+    # Lives in the main process, forked command processes read the copy they inherited,
+    # which always holds the messages received before the one they handle.
+    def __init__(self,
+                 size: int=64,
+                 max_targets: int=1024):
+        self.size = size
+        self.max_targets = max_targets
+        self.lock = threading.Lock()
+        self.targets = OrderedDict()
+        self.index = {}
+
+    def Add(self,
+            record: HistoryRecord):
+        key = (record.message_type, record.target_id)
+        with self.lock:
+            ring = self.targets.get(key, None)
+            if ring is None:
+                ring = self.targets[key] = deque(maxlen=self.size)
+                if len(self.targets) > self.max_targets:
+                    _, evicted_ring = self.targets.popitem(last=False)
+                    for evicted in evicted_ring:
+                        self.forget(evicted)
+            else:
+                self.targets.move_to_end(key)
+            if len(ring) == ring.maxlen:
+                self.forget(ring[0])
+            ring.append(record)
+            self.index[record.message_id] = record
+
+    def forget(self,
+               record: HistoryRecord):
+        # Caller holds the lock
+        if self.index.get(record.message_id) is record:
+            del self.index[record.message_id]
+
+    def Get(self,
+            message_id: int):
+        # Lock free, readers in forked processes must not wait on a lock held at fork time
+        return self.index.get(message_id, None)
+
+    def Recent(self,
+               message_type: str,
+               target_id: int|str,
+               count: int=10):
+        ring = self.targets.get((message_type, target_id), ())
+        return list(ring)[-count:]
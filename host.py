@@ -0,0 +1,189 @@
+from utils import handle_exceptions_for_methods, CreateSession, merge_dict, logger
+from omegaconf import OmegaConf
+from server import CreateApp, StartServer
+from media import MediaTransfer
+from shutdown import ResetChildSignals
+from reload import FileWatcher
+from OneBot import OneBot
+import multiprocessing
+import threading
+import traceback
+import logging
+import signal
+import time
+import sys
+import os
+
+# Account parameters the host sets itself, they are not saved with the account
+HOST_KEYS = ["SelfID", "HttpPostHost", "HttpPostPort", "Logger", "StateDir", "HotReload", "MediaTransfer"]
+
+class SharedResources:
+    # Everything the hosted accounts share: one Manager process, one HTTP connection pool,
+    # one media store. Command modules and their caches are shared by living in the same process.
+    def __init__(self,
+                 MediaConfig: dict={}):
+        self.Manager = multiprocessing.Manager()
+        self.Session = CreateSession()
+        self.Media = MediaTransfer(**MediaConfig)
+        self.Bots = {}
+        self.Host = None
+
+@handle_exceptions_for_methods
+class OneBotHost:
+    # Serves many bot accounts from one process. Every event is routed to its account by `self_id`,
+    # each account keeps its own admin, commands, admission and state.
+    def __init__(self,
+                 HttpPostHost: str,
+                 HttpPostPort: int,
+                 Logger: logging.Logger,
+                 Accounts: dict,
+                 Common: dict={},
+                 StateDir: str="./state",
+                 HotReload: bool=False,
+                 ConfigPath: str="",
+                 MediaTransfer: dict={},
+                 **kwargs):
+
+        self.HttpPostHost = HttpPostHost
+        self.HttpPostPort = HttpPostPort
+        self.Logger = Logger
+        self.StateDir = StateDir
+        self.HotReload = HotReload
+        self.ConfigPath = os.path.abspath(ConfigPath) if ConfigPath else ""
+        self.Common = Common
+        self.MediaConfig = MediaTransfer
+        self.MainPID = os.getpid()
+
+        if kwargs != {}:
+            logger.warning("Unrecognized parameters: {}".format(kwargs))
+
+        logger.info("HttpPostHost: {}".format(self.HttpPostHost))
+        logger.info("HttpPostPort: {}".format(self.HttpPostPort))
+        logger.info("Accounts: {}".format(list(Accounts.keys())))
+
+        self.Shared = SharedResources(MediaTransfer)
+        self.Shared.Host = self
+        self.Bots = self.Shared.Bots
+        for self_id, account in Accounts.items():
+            self_id = int(self_id)
+            params = self.account_params(self_id, account)
+            params.update({"Logger": Logger,
+                           "Shared": self.Shared})
+            logger.info("Initialize account {}".format(self_id))
+            self.Bots[self_id] = OneBot(**params)
+
+        self._init_signals()
+        self._init_reloader()
+        self.Server = StartServer(CreateApp(self.Bots.get, self.Shared.Media),
+                                  self.HttpPostHost, self.HttpPostPort)
+        logger.info("OneBotHost is initialized with {} accounts".format(len(self.Bots)))
+
+    def account_params(self,
+                       self_id: int,
+                       account: dict):
+        params = merge_dict(self.Common, account)
+        params.update({"SelfID": self_id,
+                       "HttpPostHost": self.HttpPostHost,
+                       "HttpPostPort": self.HttpPostPort,
+                       "StateDir": os.path.join(self.StateDir, str(self_id)),
+                       "HotReload": False})
+        return params
+
+    def get_config(self):
+        # A config `main.py` starts the host from, every account with its current commands
+        accounts = {}
+        for self_id, bot in self.Bots.items():
+            account = OmegaConf.to_container(bot.get_config())
+            accounts[self_id] = {key: value for key, value in account.items() if key not in HOST_KEYS}
+        return OmegaConf.create({"HttpPostHost": self.HttpPostHost,
+                                 "HttpPostPort": self.HttpPostPort,
+                                 "StateDir": self.StateDir,
+                                 "HotReload": self.HotReload,
+                                 "MediaTransfer": self.MediaConfig,
+                                 "Accounts": accounts})
+
+    def _init_signals(self):
+        self.StopSignal = 0
+
+        def signal_handler(sig, frame):
+            if os.getpid() != self.MainPID:
+                return
+            # Shut down from the run loop, between ticks no account holds a lock
+            logger.info("Received signal {}, shut down after the current tick".format(sig))
+            self.StopSignal = sig
+
+        signal.signal(signal.SIGINT, signal_handler)
+        signal.signal(signal.SIGTERM, signal_handler)
+        os.register_at_fork(after_in_child=ResetChildSignals)
+
+    def _init_reloader(self):
+        # One watcher for all accounts, a module is reloaded once and every account rebinds to it
+        self.Watcher = None
+        if self.HotReload and self.Bots:
+            self.Watcher = FileWatcher(["./configs", "./cmds"], self.on_change)
+            self.Watcher.start()
+
+    def on_change(self,
+                  paths: set):
+        bot = next(iter(self.Bots.values()))
+        modules = [module for module in map(bot.Reloader.path_to_module, paths) if module]
+        if modules:
+            bot.RequestControl("reload", modules=modules)
+        if self.ConfigPath in paths:
+            self.ReloadConfig()
+
+    def load_accounts(self):
+        if not self.ConfigPath:
+            logger.warning("No config path to reload from")
+            return {}
+        config = OmegaConf.to_container(OmegaConf.load(self.ConfigPath))
+        params = config.get("params", config)
+        self.Common = params.get("Common", {})
+        return {int(self_id): account for self_id, account in params.get("Accounts", {}).items()}
+
+    def LoadAccountParams(self,
+                          self_id: int):
+        # Params of one account as the host would start it from the current config file
+        accounts = self.load_accounts()
+        if self_id not in accounts:
+            logger.warning("Account {} not found in config {}".format(self_id, self.ConfigPath))
+            return None
+        return self.account_params(self_id, accounts[self_id])
+
+    def ReloadConfig(self):
+        # Each account reloads the commands of its own entry, merged with `Common` as at start
+        accounts = self.load_accounts()
+        for self_id, bot in self.Bots.items():
+            if self_id not in accounts:
+                logger.warning("Account {} removed from config, it takes effect after restart".format(self_id))
+                continue
+            bot.RequestControl("reload", config=True, params=self.account_params(self_id, accounts[self_id]))
+        for self_id in set(accounts) - set(self.Bots):
+            logger.warning("Account {} added to config, it takes effect after restart".format(self_id))
+
+    def Stop(self,
+             sig: int=signal.SIGTERM):
+        # Accounts drain in parallel so that the slowest one bounds the shutdown, not their sum
+        threads = [threading.Thread(target=bot.Stop, args=(sig,), name="stop-{}".format(self_id))
+                   for self_id, bot in self.Bots.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def run(self):
+
+        while not self.StopSignal:
+            for self_id, bot in self.Bots.items():
+                try:
+                    bot.Tick()
+                except Exception as e:
+                    logger.error("Exception in 'run' of account {}: {}".format(self_id, e))
+                    traceback_str = traceback.format_exc()
+                    logger.error("Traceback: {}".format(traceback_str))
+            time.sleep(1)
+
+        self.Stop(self.StopSignal)
+        self.Server.should_exit = True
+        logger.info("Shutdown finished, exit")
+        sys.exit(0)
@@ -30,7 +30,7 @@ if __name__ == "__main__":
     config = OmegaConf.load(cfg_file)
     
     logger.level = logging.DEBUG if args.debug else logging.INFO
-    bot = instantiate_from_config(config, isfunc=False, add_params={"Logger": logger})
+    bot = instantiate_from_config(config, isfunc=False, add_params={"Logger": logger, "ConfigPath": cfg_file})
     bot.run()
     
     
\ No newline at end of file
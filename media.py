@@ -0,0 +1,137 @@
+from utils import handle_exceptions_for_methods, logger
+import hashlib
+import base64
+import shutil
+import hmac
+import time
+import os
+
+@handle_exceptions_for_methods
+class MediaTransfer:
+    # Decides how a local file reaches the OneBot implementation:
+    #   path:   the raw filesystem path, only works when both share a filesystem
+    #   base64: the file inlined as `base64://`, for small files
+    #   url:    a signed URL served by the bot's own http server. Files are published under
+    #           their content hash and the URL is stable for `ttl`, so the OneBot side caches
+    #           a re-sent file instead of downloading it again.
+    # `auto` keeps files that were already published on their URL, inlines small files and
+    # publishes the rest, falling back to `path` when there is no `public_url`.
+    # A published entry is removed once no URL handed out for it can still be valid.
+    def __init__(self,
+                 mode: str="path",
+                 inline_max_bytes: int=256 * 1024,
+                 public_url: str="",
+                 secret: str="",
+                 ttl: int=3600,
+                 media_dir: str="./media"):
+        self.mode = mode
+        self.inline_max_bytes = inline_max_bytes
+        self.public_url = public_url.rstrip("/")
+        self.secret = (secret or os.urandom(16).hex()).encode()
+        self.ttl = ttl
+        self.media_dir = media_dir
+        self.digests = {}
+        self.last_prune = time.time()
+        if self.mode == "url" and not self.public_url:
+            # A relative URL cannot be fetched by the OneBot implementation
+            logger.warning("MediaTransfer mode `url` needs a `public_url`, fall back to `path`")
+            self.mode = "path"
+        if self.mode in ["url", "auto"]:
+            os.makedirs(self.media_dir, exist_ok=True)
+
+    def digest(self,
+               path: str):
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if key not in self.digests:
+            sha256 = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    sha256.update(chunk)
+            self.digests[key] = sha256.hexdigest()
+        return self.digests[key]
+
+    def sign(self,
+             name: str,
+             expires: int):
+        return hmac.new(self.secret, "{}:{}".format(name, expires).encode(), hashlib.sha256).hexdigest()[:32]
+
+    def published_path(self,
+                       name: str):
+        return os.path.join(self.media_dir, name)
+
+    def publish(self,
+                path: str):
+        name = self.digest(path) + os.path.splitext(path)[1].lower()
+        published_path = self.published_path(name)
+        if not os.path.exists(published_path):
+            tmp_path = "{}.{}.tmp".format(published_path, os.getpid())
+            try:
+                os.link(path, tmp_path)
+            except OSError:
+                shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, published_path)
+        else:
+            # Published again, keep it until the URL below expires
+            os.utime(published_path)
+        # Expiry is rounded up to the next ttl boundary, so the URL of a file stays the same for a while
+        expires = (int(time.time()) // self.ttl + 2) * self.ttl
+        return "{}/media/{}?expires={}&sig={}".format(self.public_url, name, expires, self.sign(name, expires))
+
+    def inline(self,
+               path: str):
+        with open(path, "rb") as f:
+            return "base64://" + base64.b64encode(f.read()).decode()
+
+    def choose_mode(self,
+                    path: str):
+        if self.mode != "auto":
+            return self.mode
+        if not self.public_url:
+            return "base64" if os.path.getsize(path) <= self.inline_max_bytes else "path"
+        name = self.digest(path) + os.path.splitext(path)[1].lower()
+        if os.path.exists(self.published_path(name)):
+            return "url"
+        return "base64" if os.path.getsize(path) <= self.inline_max_bytes else "url"
+
+    def Prepare(self,
+                path: str):
+        mode = self.choose_mode(path)
+        logger.debug("Transfer {} by {}".format(path, mode))
+        if mode == "base64":
+            return {"file": self.inline(path)}
+        if mode == "url":
+            url = self.publish(path)
+            return {"file": url, "url": url, "cache": 1}
+        return {"file": path}
+
+    def Prune(self):
+        # URLs expire at most 2 * ttl after they were handed out
+        removed = 0
+        for entry in os.scandir(self.media_dir):
+            if entry.is_file() and time.time() - entry.stat().st_mtime > 2 * self.ttl:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    continue
+                removed += 1
+        if removed:
+            logger.info("Remove {} expired files from {}".format(removed, self.media_dir))
+        return removed
+
+    def MaybePrune(self):
+        if self.mode not in ["url", "auto"] or time.time() - self.last_prune < self.ttl / 2:
+            return
+        self.last_prune = time.time()
+        self.Prune()
+
+    def Resolve(self,
+                name: str,
+                expires: int,
+                sig: str):
+        if os.path.basename(name) != name or expires < time.time():
+            return None
+        if not hmac.compare_digest(self.sign(name, expires), sig):
+            return None
+        path = self.published_path(name)
+        return path if os.path.exists(path) else None
@@ -0,0 +1,281 @@
+from utils import handle_exceptions_for_methods, logger
+from omegaconf import OmegaConf
+import ctypes.util
+import importlib
+import threading
+import ctypes
+import types
+import select
+import struct
+import time
+import sys
+import os
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_EVENT_HEADER = struct.Struct("iIII")
+# Config keys the bot keeps under another attribute name
+CONFIG_ATTRIBUTES = {"Admission": "AdmissionConfig", 
+                     "MediaTransfer": "MediaConfig", 
+                     "MessageHistory": "HistoryConfig"}
+
+@handle_exceptions_for_methods
+class FileWatcher:
+    # Watches directories with inotify and falls back to polling modification times when
+    # inotify is not available. `callback` receives the set of changed paths.
+    def __init__(self,
+                 paths: list,
+                 callback,
+                 suffixes: tuple=(".py", ".yaml"),
+                 debounce: float=0.5,
+                 poll_interval: float=1):
+        self.paths = [os.path.abspath(path) for path in paths if os.path.isdir(path)]
+        self.callback = callback
+        self.suffixes = suffixes
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.fd = -1
+        self.watches = {}
+        self.mtimes = {}
+
+    def init_inotify(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return False
+        for path in self.paths:
+            wd = libc.inotify_add_watch(fd, path.encode(),
+                                        IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE)
+            if wd < 0:
+                os.close(fd)
+                return False
+            self.watches[wd] = path
+        self.fd = fd
+        return True
+
+    def read_inotify(self,
+                     timeout: float):
+        changed = set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return changed
+        data = os.read(self.fd, 65536)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = IN_EVENT_HEADER.unpack_from(data, offset)
+            offset += IN_EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0").decode()
+            offset += length
+            if name.endswith(self.suffixes):
+                changed.add(os.path.join(self.watches[wd], name))
+        return changed
+
+    def scan(self):
+        mtimes = {}
+        for path in self.paths:
+            for name in os.listdir(path):
+                if name.endswith(self.suffixes):
+                    filepath = os.path.join(path, name)
+                    mtimes[filepath] = os.path.getmtime(filepath)
+        return mtimes
+
+    def read_polling(self):
+        time.sleep(self.poll_interval)
+        mtimes = self.scan()
+        changed = {path for path in set(mtimes) | set(self.mtimes)
+                   if mtimes.get(path) != self.mtimes.get(path)}
+        self.mtimes = mtimes
+        return changed
+
+    def watch(self):
+        if self.init_inotify():
+            logger.info("Watch {} with inotify".format(self.paths))
+            read = lambda: self.read_inotify(None)
+        else:
+            logger.info("inotify is not available, poll {} every {}s".format(self.paths, self.poll_interval))
+            self.mtimes = self.scan()
+            read = self.read_polling
+        while True:
+            changed = read()
+            if not changed:
+                continue
+            if self.fd >= 0:
+                # Editors write files in several steps, collect them into one reload
+                deadline = time.time() + self.debounce
+                while deadline > time.time():
+                    changed |= self.read_inotify(deadline - time.time())
+            self.callback(changed)
+
+    def start(self):
+        threading.Thread(target=self.watch, daemon=True).start()
+
+@handle_exceptions_for_methods
+class Reloader:
+    def __init__(self,
+                 bot,
+                 ConfigPath: str="",
+                 WatchDirs: list=["./configs", "./cmds"]):
+        self.bot = bot
+        self.ConfigPath = os.path.abspath(ConfigPath) if ConfigPath else ""
+        self.WatchDirs = WatchDirs
+        self.Watcher = None
+
+    def start_watching(self):
+        self.Watcher = FileWatcher(self.WatchDirs, self.on_change)
+        self.Watcher.start()
+
+    def on_change(self,
+                  paths: set):
+        logger.info("Files changed: {}".format(sorted(paths)))
+        modules = [module for module in map(self.path_to_module, paths) if module]
+        config = self.ConfigPath in paths
+        if modules or config:
+            self.bot.RequestControl("reload", modules=modules, config=config)
+
+    def path_to_module(self,
+                       path: str):
+        relpath = os.path.relpath(os.path.abspath(path))
+        if not relpath.endswith(".py") or relpath.startswith(".."):
+            return None
+        module_name = relpath[:-3].replace(os.sep, ".")
+        return module_name if module_name in sys.modules else None
+
+    def command_modules(self):
+        return {bot.Commands[cmd_name]["target"].rsplit(".", 1)[0]
+                for bot in self.peers() for cmd_name in bot.Commands.keys()}
+
+    def ReloadModules(self,
+                      modules: list):
+        if not modules:
+            modules = sorted(self.command_modules())
+        reloaded = []
+        for module_name in modules:
+            if module_name not in sys.modules:
+                logger.warning("Module {} is not loaded, skip reloading".format(module_name))
+                continue
+            importlib.reload(sys.modules[module_name])
+            reloaded.append(module_name)
+        # Command modules that `from`-import a reloaded module still hold its old objects,
+        # reload them after it, and the modules that import them in turn
+        dependents = self.dependents(reloaded)
+        while dependents:
+            for module_name in dependents:
+                importlib.reload(sys.modules[module_name])
+            reloaded += dependents
+            dependents = self.dependents(reloaded)
+
+        # Modules are shared by every hosted account, each of them rebinds to the reloaded functions
+        rebuilt = []
+        for bot in self.peers():
+            rebuilt += self.rebind(bot, reloaded)
+        logger.info("Reloaded modules {}, rebuilt commands {}".format(reloaded, rebuilt))
+        return reloaded, rebuilt
+
+    def dependents(self,
+                   reloaded: list):
+        # Loaded `cmds.*` modules that reference a reloaded module or anything defined in it
+        dependents = []
+        for module_name, module in list(sys.modules.items()):
+            if not module_name.startswith("cmds.") or module_name in reloaded or module is None:
+                continue
+            for value in list(vars(module).values()):
+                source = value.__name__ if isinstance(value, types.ModuleType) else getattr(value, "__module__", None)
+                if source in reloaded:
+                    dependents.append(module_name)
+                    break
+        return sorted(dependents)
+
+    def peers(self):
+        if self.bot.Shared:
+            return list(self.bot.Shared.Bots.values())
+        return [self.bot]
+
+    def rebind(self,
+               bot,
+               reloaded: list):
+        # Build a new table and swap it in one assignment, processes that are already running
+        # keep the functions they were forked with
+        command_functions = dict(bot.CommandFunctions)
+        rebuilt = []
+        for cmd_name in bot.Commands.keys():
+            module_name, target = bot.Commands[cmd_name]["target"].rsplit(".", 1)
+            if module_name in reloaded:
+                command_functions[cmd_name] = getattr(sys.modules[module_name], target)
+                rebuilt.append(cmd_name)
+        bot.CommandFunctions = command_functions
+        return rebuilt
+
+    def ReloadConfig(self,
+                     params: dict=None):
+        # A hosted account gets its params from the host, which owns the config file
+        if params is None and self.bot.Shared:
+            params = self.bot.Shared.Host.LoadAccountParams(self.bot.SelfID)
+            if params is None:
+                return [], []
+        if params is None:
+            if not self.ConfigPath:
+                logger.warning("No config path to reload from")
+                return [], []
+            config = OmegaConf.to_container(OmegaConf.load(self.ConfigPath))
+            params = config.get("params", config)
+        new_commands = {}
+        for cmd_type in ["Manual", "Auto", "Post", "Event"]:
+            for cmd_name, cmd_cfg in params.get(cmd_type + "Commands", {}).items():
+                new_commands[cmd_name] = (cmd_type, cmd_cfg)
+
+        changed, removed = [], []
+        command_functions = dict(self.bot.CommandFunctions)
+        built = {}
+        for cmd_name, (cmd_type, cmd_cfg) in new_commands.items():
+            if cmd_cfg == self.bot.OrginalCommands.get(cmd_name) and \
+               cmd_type == self.bot.Commands.get(cmd_name, {}).get("CommandType"):
+                continue
+            func, cmd = self.bot.BuildCommand(cmd_type, cmd_cfg)
+            command_functions[cmd_name] = func
+            built[cmd_name] = cmd
+            changed.append(cmd_name)
+        for cmd_name in list(self.bot.Commands.keys()):
+            if cmd_name not in new_commands:
+                command_functions.pop(cmd_name, None)
+                removed.append(cmd_name)
+
+        with self.bot.COMMAND_LOCK:
+            commands = self.bot.Commands
+            for cmd_name, cmd in built.items():
+                old_cmd = commands.get(cmd_name, {})
+                # Keep runtime data such as chat history across the rebuild
+                cmd.update({key: value for key, value in old_cmd.items()
+                            if key not in ["CommandType", "target", "params", "extra_params"]})
+                commands[cmd_name] = cmd
+            self.bot.CommandFunctions = command_functions
+            for cmd_name in removed:
+                commands.pop(cmd_name, None)
+            self.bot.Commands = commands
+        self.bot.OrginalCommands = {cmd_name: cmd_cfg for cmd_name, (_, cmd_cfg) in new_commands.items()}
+        if changed or removed:
+            self.bot.BuildEventRouter()
+            self.bot.BuildAttributeIndexes(changed + removed)
+
+        for key in params:
+            attribute = CONFIG_ATTRIBUTES.get(key, key)
+            if not key.endswith("Commands") and getattr(self.bot, attribute, None) != params[key]:
+                logger.warning("Parameter {} changed in config, it takes effect after restart".format(key))
+        logger.info("Reloaded config {}, rebuilt commands {}, removed commands {}".format(
+                    self.ConfigPath or "from host", changed, removed))
+        return changed, removed
+
+    def Reload(self,
+               modules: list=[],
+               config: bool=False,
+               params: dict=None):
+        results = []
+        if modules or not config:
+            reloaded, rebuilt = self.ReloadModules(modules)
+            results.append("已重新加载模块 {}, 更新命令 {}".format(reloaded, rebuilt))
+        if config:
+            changed, removed = self.ReloadConfig(params)
+            results.append("已重新加载配置, 更新命令 {}, 移除命令 {}".format(changed, removed))
+        return "\n".join(results)
@@ -0,0 +1,47 @@
+from events import PeekPostType, PeekSelfID, ParseEvent, loads
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import FileResponse
+from utils import logger
+import threading
+import logging
+import uvicorn
+
+def CreateApp(resolve_bot,
+              media):
+    # `resolve_bot(self_id)` returns the account an event belongs to, or None to drop the event
+    app = FastAPI()
+
+    @app.post("/")
+    async def read_event(request: Request):
+        body = await request.body()
+        bot = resolve_bot(PeekSelfID(body))
+        if bot is None:
+            return Response(status_code=204)
+        if not bot.Shutdown.is_accepting():
+            return Response(status_code=503)
+        # Only post types with a handler are decoded, everything else is answered right after peeking at the body
+        if PeekPostType(body) not in bot.EventTypes:
+            return Response(status_code=204)
+        event = ParseEvent(loads(body))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Receive Event :{}".format(event))
+        bot.Router.Dispatch(event)
+        return Response(status_code=204)
+
+    @app.get("/media/{name}")
+    async def read_media(name: str,
+                         expires: int,
+                         sig: str):
+        path = media.Resolve(name, expires, sig)
+        if path is None:
+            return Response(status_code=404)
+        return FileResponse(path)
+
+    return app
+
+def StartServer(app,
+                host: str,
+                port: int):
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port))
+    threading.Thread(target=server.run, daemon=True).start()
+    return server
@@ -0,0 +1,164 @@
+from utils import handle_exceptions_for_methods, logger
+import multiprocessing
+import threading
+import signal
+import time
+import os
+
+# Seconds between asking unbounded work to stop and killing it
+STOP_GRACE = 3
+
+def ResetChildSignals():
+    # Forked processes must die on `terminate()`, the SIGTERM handler inherited from the main
+    # process would only ignore it there
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+@handle_exceptions_for_methods
+class ShutdownCoordinator:
+    def __init__(self,
+                 bot,
+                 Timeout: float=30,
+                 PostTimeout: float=30):
+        self.bot = bot
+        self.Timeout = Timeout
+        self.PostTimeout = PostTimeout
+        self.MainPID = os.getpid()
+        self.Accepting = threading.Event()
+        self.Accepting.set()
+        self.InflightLock = threading.Lock()
+        self.Inflight = []
+        self.Drainers = []
+        self.Stopping = False
+
+    def is_accepting(self):
+        return self.Accepting.is_set()
+
+    def is_main_process(self):
+        return os.getpid() == self.MainPID
+
+    def Track(self,
+              process: multiprocessing.Process,
+              description: str):
+        with self.InflightLock:
+            self.Inflight = [(p, d) for p, d in self.Inflight if p.is_alive()]
+            self.Inflight.append((process, description))
+
+    def Reap(self):
+        with self.InflightLock:
+            alive = []
+            for process, description in self.Inflight:
+                if process.is_alive():
+                    alive.append((process, description))
+                else:
+                    process.join()
+            self.Inflight = alive
+        return len(alive)
+
+    def RegisterDrainer(self,
+                        name: str,
+                        drainer):
+        # `drainer(deadline)` waits for its own work until `deadline` and returns what it abandoned.
+        # Drainers run in parallel, work that never ends by itself should be stopped right away.
+        self.Drainers.append((name, drainer))
+
+    def RunDrainers(self,
+                    deadline: float):
+        report = {name: [] for name, _ in self.Drainers}
+
+        def run_drainer(name, drainer):
+            report[name] = drainer(deadline) or []
+
+        threads = [threading.Thread(target=run_drainer, args=(name, drainer), name="drain-{}".format(name))
+                   for name, drainer in self.Drainers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return report
+
+    def DrainInflight(self,
+                      deadline: float):
+        with self.InflightLock:
+            inflight = list(self.Inflight)
+        abandoned = []
+        for process, description in inflight:
+            process.join(max(0, deadline - time.time()))
+            if process.is_alive():
+                abandoned.append((process, description))
+        for process, description in abandoned:
+            process.terminate()
+        for process, description in abandoned:
+            process.join(1)
+            if process.is_alive():
+                process.kill()
+                process.join()
+        with self.InflightLock:
+            self.Inflight = []
+        return [description for _, description in abandoned]
+
+    def RunPostCommands(self,
+                        deadline: float):
+        commands = self.bot.Commands
+        post_commands = {cmd_name: commands[cmd_name].get("extra_params", {}).get("depends_on", [])
+                         for cmd_name in commands.keys()
+                         if commands[cmd_name]["CommandType"] == "Post"}
+        # `done` is set once a post command ran or was skipped, dependents of a skipped one are skipped too
+        done = {cmd_name: threading.Event() for cmd_name in post_commands}
+        skipped = []
+
+        def run_post_command(cmd_name, depends_on):
+            try:
+                for dependency in depends_on:
+                    if dependency not in done:
+                        logger.warning("Post command '{}' depends on unknown post command '{}'".format(
+                                       cmd_name, dependency))
+                        continue
+                    if not done[dependency].wait(max(0, deadline - time.time())) or dependency in skipped:
+                        logger.warning("Post command '{}' gave up waiting for '{}'".format(cmd_name, dependency))
+                        skipped.append(cmd_name)
+                        return
+                logger.info("Handle post command: {}".format(cmd_name))
+                self.bot.HandleCommand(cmd_name, "", "", 0, 0, 0, False)
+            finally:
+                done[cmd_name].set()
+
+        threads = {}
+        for cmd_name, depends_on in post_commands.items():
+            thread = threading.Thread(target=run_post_command, args=(cmd_name, depends_on), daemon=True)
+            thread.start()
+            threads[cmd_name] = thread
+        for cmd_name, thread in threads.items():
+            thread.join(max(0, deadline - time.time()))
+            if thread.is_alive():
+                # Post commands such as saving the config must not be cut off by the exit
+                logger.warning("Post command '{}' is still running after the deadline, wait for it".format(cmd_name))
+                thread.join()
+        return skipped
+
+    def Shutdown(self,
+                 sig: int):
+        if self.Stopping:
+            logger.warning("Received signal {} while shutting down, ignored".format(sig))
+            return {}
+        self.Stopping = True
+        self.Accepting.clear()
+        logger.info("Received signal {}, stop accepting events and drain in {}s".format(sig, self.Timeout))
+
+        # Drainers run first, pending command batches are started and tracked before in-flight
+        # commands are waited for
+        deadline = time.time() + self.Timeout
+        report = self.RunDrainers(deadline)
+        report["commands"] = self.DrainInflight(deadline)
+        logger.info("In-flight work drained")
+
+        # Post commands get a budget of their own, whatever draining took
+        report["post_commands"] = self.RunPostCommands(time.time() + self.PostTimeout)
+        logger.info("Post commands handled")
+
+        abandoned = {name: items for name, items in report.items() if items}
+        if abandoned:
+            for name, items in abandoned.items():
+                logger.warning("Abandoned {} {}: {}".format(len(items), name, items))
+        else:
+            logger.info("Nothing abandoned")
+        return report
@@ -0,0 +1,126 @@
+from utils import handle_exceptions_for_methods, AtomicWrite, logger
+import fcntl
+import json
+import time
+import os
+
+SNAPSHOT_VERSION = 1
+
+@handle_exceptions_for_methods
+class StateStore:
+    # Write-ahead journal of runtime changes on top of a periodically compacted snapshot.
+    # Records are single JSON lines appended under `flock`, so forked command processes
+    # can journal their own changes. Every record is idempotent, replaying one that is
+    # already part of the snapshot is harmless.
+    def __init__(self,
+                 StateDir: str="./state",
+                 CompactBytes: int=1 << 20,
+                 CompactInterval: float=600,
+                 Lock=None):
+        self.StateDir = StateDir
+        self.Lock = Lock
+        self.CompactBytes = CompactBytes
+        self.CompactInterval = CompactInterval
+        self.SnapshotPath = os.path.join(StateDir, "snapshot.json")
+        self.JournalPath = os.path.join(StateDir, "journal.jsonl")
+        self.LastCompact = time.time()
+        os.makedirs(StateDir, exist_ok=True)
+
+    def Append(self,
+               record: dict,
+               sync: bool=True):
+        line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+        with open(self.JournalPath, "a", encoding="utf-8") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(line)
+                f.flush()
+                if sync:
+                    os.fsync(f.fileno())
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def Apply(self, 
+              state: dict,
+              record: dict):
+        op = record.get("op")
+        commands = state.setdefault("commands", {})
+        if op == "set":
+            current = commands.setdefault(record["cmd"], {})
+            for key in record["path"][:-1]:
+                current = current.setdefault(key, {})
+            current[record["path"][-1]] = record["value"]
+        elif op == "chat":
+            chat_history = commands.setdefault(record["cmd"], {}).setdefault("chat_history", {})
+            chat_history[record["target"]] = record["history"]
+        elif op == "scheduler":
+            state.setdefault("scheduler", {}).setdefault(record["cmd"], {}).update(record["stats"])
+        else:
+            logger.warning("Unknown state journal record: {}".format(record))
+        return state
+
+    def Load(self):
+        start = time.time()
+        state = {"config": {}, "commands": {}, "scheduler": {}}
+        if os.path.exists(self.SnapshotPath):
+            with open(self.SnapshotPath, "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+            if snapshot.get("version") == SNAPSHOT_VERSION:
+                # The command config the state was saved against, edits of the config file win over it
+                state["config"] = snapshot.get("config", {})
+                state["commands"] = snapshot.get("commands", {})
+                state["scheduler"] = snapshot.get("scheduler", {})
+            else:
+                logger.warning("Ignore state snapshot with version {}".format(snapshot.get("version")))
+
+        replayed = 0
+        if os.path.exists(self.JournalPath):
+            with open(self.JournalPath, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A torn last line from a crash in the middle of `Append`
+                        logger.warning("Stop replaying state journal at a broken record")
+                        break
+                    self.Apply(state, record)
+                    replayed += 1
+        logger.info("State loaded from {} with {} journal records in {:.3f}s".format(
+                    self.StateDir, replayed, time.time() - start))
+        return state
+
+    def Compact(self,
+                capture):
+        # Writers journal a change and then apply it while holding `Lock`. Holding it here means
+        # a snapshot never misses a change whose record it truncates.
+        if self.Lock is None:
+            return self.compact(capture)
+        with self.Lock:
+            return self.compact(capture)
+
+    def compact(self,
+                capture):
+        # `capture` runs while the journal is locked, so no record slips in between
+        # the snapshot and the truncation
+        with open(self.JournalPath, "a", encoding="utf-8") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                state = capture()
+                snapshot = {"version": SNAPSHOT_VERSION, "time": time.time(), **state}
+                if AtomicWrite(self.SnapshotPath, json.dumps(snapshot, ensure_ascii=False, default=str)) is None:
+                    logger.warning("Failed to write state snapshot, keep the journal")
+                    return
+                f.truncate(0)
+                os.fsync(f.fileno())
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        self.LastCompact = time.time()
+        logger.debug("State compacted to {}".format(self.SnapshotPath))
+
+    def MaybeCompact(self,
+                     capture):
+        if not os.path.exists(self.JournalPath):
+            return
+        size = os.path.getsize(self.JournalPath)
+        if size >= self.CompactBytes or (size and time.time() - self.LastCompact >= self.CompactInterval):
+            self.Compact(capture)
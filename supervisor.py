@@ -0,0 +1,138 @@
+from utils import handle_exceptions_for_methods, logger
+from shutdown import STOP_GRACE
+import multiprocessing
+import time
+import sys
+
+def RunAutoCommand(bot,
+                   cmd_name: str):
+    # `HandleAutoCommand` returns False when the command raised and None when it failed itself,
+    # both become a failing exit code
+    if not bot.HandleAutoCommand(cmd_name):
+        sys.exit(1)
+
+@handle_exceptions_for_methods
+class AutoCommandSupervisor:
+    def __init__(self,
+                 bot,
+                 BackoffBase: float=5,
+                 BackoffMax: float=300):
+        self.bot = bot
+        self.BackoffBase = BackoffBase
+        self.BackoffMax = BackoffMax
+        self.Workers = {}
+        self.Stats = {}
+        self.Retired = set()
+
+    def get_stats(self,
+                  cmd_name: str):
+        if cmd_name not in self.Stats:
+            self.Stats[cmd_name] = {"running": 0, "started": 0, "succeeded": 0, "failed": 0,
+                                    "restarts": 0, "consecutive_failures": 0, "last_start": 0,
+                                    "last_success": 0, "last_failure": 0, "last_duration": 0,
+                                    "next_start": 0}
+        return self.Stats[cmd_name]
+
+    def Journal(self,
+                cmd_name: str):
+        stats = {key: value for key, value in self.get_stats(cmd_name).items() if key != "running"}
+        self.bot.State.Append({"op": "scheduler", "cmd": cmd_name, "stats": stats}, sync=False)
+
+    def Reap(self,
+             cmd_name: str,
+             longest_idle_interval: float=0):
+        stats = self.get_stats(cmd_name)
+        now = time.time()
+        alive = []
+        for process, started in self.Workers.get(cmd_name, []):
+            if process.is_alive() and longest_idle_interval and now - started > longest_idle_interval:
+                logger.warning("Auto command {} has run for {}s, terminate process {}".format(
+                               cmd_name, int(now - started), process.pid))
+                process.terminate()
+                process.join(1)
+                if process.is_alive():
+                    process.kill()
+            if process.is_alive():
+                alive.append((process, started))
+                continue
+            process.join()
+            stats["last_duration"] = now - started
+            if process.pid in self.Retired:
+                self.Retired.discard(process.pid)
+            elif process.exitcode == 0:
+                stats["succeeded"] += 1
+                stats["consecutive_failures"] = 0
+                stats["last_success"] = now
+            else:
+                stats["failed"] += 1
+                stats["consecutive_failures"] += 1
+                stats["last_failure"] = now
+                backoff = min(self.BackoffMax, self.BackoffBase * 2 ** (stats["consecutive_failures"] - 1))
+                stats["next_start"] = now + backoff
+                logger.warning("Auto command {} exited with code {}, restart in {}s".format(
+                               cmd_name, process.exitcode, backoff))
+            self.Journal(cmd_name)
+        self.Workers[cmd_name] = alive
+        stats["running"] = len(alive)
+        return alive
+
+    def Supervise(self):
+        commands = self.bot.Commands
+        for cmd_name in list(self.Workers.keys()):
+            if cmd_name not in commands.keys():
+                # Removed by a reload, let the remaining workers finish
+                if not self.Reap(cmd_name):
+                    self.Workers.pop(cmd_name)
+        for cmd_name in commands.keys():
+            cmd_dict = commands[cmd_name]
+            if cmd_dict["CommandType"] != "Auto":
+                continue
+            auto_params = cmd_dict["extra_params"]["auto_params"]
+            stats = self.get_stats(cmd_name)
+            alive = self.Reap(cmd_name, auto_params.get("longest_idle_interval", 0))
+            if not auto_params["run"]:
+                continue
+            num_process = auto_params.get("num_process", 1)
+
+            for process, _ in alive[num_process:]:
+                logger.info("Auto command {} has more than {} process, terminate process {}".format(
+                            cmd_name, num_process, process.pid))
+                self.Retired.add(process.pid)
+                process.terminate()
+
+            now = time.time()
+            if len(alive) >= num_process or now < stats["next_start"]:
+                continue
+            if now - stats["last_start"] < auto_params["min_execution_interval"]:
+                continue
+            for i in range(num_process - len(alive)):
+                process = multiprocessing.Process(target=RunAutoCommand, args=(self.bot, cmd_name))
+                process.start()
+                self.Workers[cmd_name].append((process, time.time()))
+                if stats["consecutive_failures"]:
+                    stats["restarts"] += 1
+                stats["started"] += 1
+                stats["last_start"] = time.time()
+                logger.debug("Start a process for auto command '{}', now {} / {} process is alive".format(
+                             cmd_name, len(self.Workers[cmd_name]), num_process))
+            stats["running"] = len(self.Workers[cmd_name])
+            self.Journal(cmd_name)
+
+    def Drain(self,
+              deadline: float):
+        # Auto commands run again after a restart, they are stopped right away instead of
+        # holding the shutdown until the deadline
+        workers = [(cmd_name, process) for cmd_name, processes in self.Workers.items()
+                   for process, _ in processes if process.is_alive()]
+        for _, process in workers:
+            process.terminate()
+        grace = min(deadline, time.time() + STOP_GRACE)
+        abandoned = []
+        for cmd_name, process in workers:
+            process.join(max(0, grace - time.time()))
+            if process.is_alive():
+                process.kill()
+            process.join()
+            abandoned.append("auto command {} (pid {})".format(cmd_name, process.pid))
+        self.Workers = {}
+        return abandoned
@@ -4,7 +4,10 @@ from omegaconf import OmegaConf
 import functools
 import importlib
 import traceback
+import requests
+import tempfile
 import logging
+import os
 
 def handle_exceptions_for_methods(cls):
     for name, method in vars(cls).items():
@@ -104,6 +107,16 @@ def unformat_dict_keys(d, sep=".", rep="§"):
         current_dict[keys[-1]] = value
     return original_dict
 
+@handle_exceptions
+def merge_dict(base, override):
+    merged = dict(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_dict(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
 @handle_exceptions
 def String2Dict(string: str, 
                 default_key: str, 
@@ -113,4 +126,33 @@ def String2Dict(string: str,
     items = string.split(sep)
     return {item.split("=")[0]: item.split("=")[1] for item in items}
 
+@handle_exceptions
+def CreateSession():
+    session = requests.Session()
+    # A forked process must not reuse the parent's pooled connections, it starts with an empty pool
+    os.register_at_fork(after_in_child=session.close)
+    return session
+
+@handle_exceptions
+def AtomicWrite(path: str, 
+                data: str|bytes):
+    save_dir = os.path.dirname(os.path.abspath(path))
+    os.makedirs(save_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=save_dir, prefix=".{}.".format(os.path.basename(path)))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data.encode("utf-8") if isinstance(data, str) else data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    dir_fd = os.open(save_dir, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    return path
+
 logger = setup_logger("OneBot.log", False)